@@ -0,0 +1,286 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+"""Benchmark gitaggregate runs on generated local repositories.
+
+Generates ``--repos`` bare upstreams, each with a ``master`` branch of
+``--depth`` commits over ``--files`` files and ``--prs`` PR-like branches,
+and a config aggregating all the branches of each upstream. Then, for each
+``--jobs`` value, runs ``gitaggregate`` cold (empty workspace) and warm
+(already aggregated workspace), measuring the wall time, the amount of git
+subprocesses and the peak RSS of the run.
+
+Usage::
+
+    python benchmarks/bench_aggregate.py --jobs 1 4 --output results.json
+    python benchmarks/bench_aggregate.py --compare results.json
+    python benchmarks/bench_aggregate.py --rtt 150 --bandwidth 2000
+
+With ``--rtt``, the upstreams are served by ``git daemon`` behind a proxy
+adding latency, see :mod:`netsim`, rather than as ``file://`` remotes.
+
+Results of several versions can be compared with ``--compare``, which
+prints the ratio between the current and the given results.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+from netsim import SlowRemote
+
+AUTHOR = "Bench <bench@example.com>"
+EPOCH = 1700000000
+RUNS = ("cold", "warm")
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def git(*args, cwd=None, **kw):
+    return subprocess.check_output(
+        ("git",) + args, cwd=cwd, stderr=subprocess.DEVNULL, **kw)
+
+
+def _data(content):
+    content = content.encode()
+    return b"data %d\n%s\n" % (len(content), content)
+
+
+def make_upstream(path, depth, files, prs):
+    """Create a bare repo with a linear ``master`` and ``prs`` branches.
+
+    History is written with ``git fast-import``, so that deep histories are
+    generated quickly. Each branch adds its own file on top of a recent
+    commit of ``master``, so that the branches merge without conflicts.
+    """
+    git("init", "-q", "--bare", path)
+    stream = []
+
+    def commit(branch, mark, parent, message, path, content):
+        stream.append(b"commit refs/heads/%s\n" % branch.encode())
+        stream.append(b"mark :%d\n" % mark)
+        stream.append(b"committer %s %d +0000\n" % (
+            AUTHOR.encode(), EPOCH + mark))
+        stream.append(_data(message))
+        if parent:
+            stream.append(b"from :%d\n" % parent)
+        stream.append(b"M 100644 inline %s\n" % path.encode())
+        stream.append(_data(content))
+
+    for i in range(depth):
+        # the first commits create the files, later ones modify them
+        commit("master", i + 1, i, "commit %d" % i,
+               "file%d" % (i % files), "%d\n" % i)
+    for i in range(prs):
+        commit("pr%d" % i, depth + i + 1, depth - i % min(depth, 10),
+               "pr %d" % i, "pr%d" % i, "%d\n" % i)
+    subprocess.run(
+        ["git", "fast-import", "--quiet"], cwd=path, check=True,
+        input=b"".join(stream))
+
+
+def make_fixtures(sandbox, repos, depth, files, prs, remote=None):
+    """Create the upstreams and the config aggregating them.
+
+    :param remote: the :class:`~netsim.SlowRemote` serving the upstreams,
+                   if they are not to be used as ``file://`` remotes
+    :return: the path of the config
+    """
+    config = {}
+    for i in range(repos):
+        name = "repo%d.git" % i
+        upstream = os.path.join(sandbox, "upstreams", name)
+        make_upstream(upstream, depth, files, prs)
+        config["./workspace/repo%d" % i] = {
+            "remotes": {
+                "up": remote.url(name) if remote else "file://" + upstream,
+            },
+            "merges": ["up master"] + ["up pr%d" % j for j in range(prs)],
+            "target": "up agg",
+        }
+    config_path = os.path.join(sandbox, "repos.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return config_path
+
+
+def git_wrapper(directory):
+    """Create a ``git`` script logging its calls before running git.
+
+    With ``directory`` first on the ``PATH``, each git subprocess appends a
+    line to ``directory/calls``, which works with all versions of
+    gitaggregate, unlike counting the git calls of ``--trace``.
+
+    :return: the path of the log of the calls
+    """
+    calls_path = os.path.join(directory, "calls")
+    os.makedirs(directory, exist_ok=True)
+    script = os.path.join(directory, "git")
+    with open(script, "w") as f:
+        f.write('#!/bin/sh\necho >> "%s"\nexec "%s" "$@"\n' % (
+            calls_path, shutil.which("git")))
+    os.chmod(script, 0o755)
+    open(calls_path, "w").close()
+    return calls_path
+
+
+def run_gitaggregate(config_path, jobs):
+    """Run gitaggregate in a subprocess.
+
+    :return: a dict of the wall time, the amount of git subprocesses and
+             the peak RSS of the run
+    """
+    bin_dir = os.path.join(os.path.dirname(config_path), "bin")
+    calls_path = git_wrapper(bin_dir)
+    cmd = [
+        sys.executable, "-c",
+        "from git_aggregator.main import main; main()",
+        "-c", config_path, "-j", str(jobs), "--log-level", "WARNING",
+    ]
+    # benchmark the source tree this script belongs to
+    env = dict(
+        os.environ,
+        PATH=os.pathsep.join([bin_dir, os.environ.get("PATH", "")]),
+        PYTHONPATH=os.pathsep.join(
+            filter(None, [SOURCE_DIR, os.environ.get("PYTHONPATH")])),
+    )
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        cmd, cwd=os.path.dirname(config_path), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # the rusage of wait4 covers the process and its waited for children,
+    # git subprocesses included
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    with open(calls_path) as f:
+        subprocesses = sum(1 for _ in f)
+    peak_rss = rusage.ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on macOS, KiB elsewhere
+        peak_rss //= 1024
+    return {
+        "wall_seconds": round(wall, 3),
+        "subprocesses": subprocesses,
+        "peak_rss_kib": peak_rss,
+    }
+
+
+def bench(config_path, jobs_values, repeat):
+    workspace = os.path.join(os.path.dirname(config_path), "workspace")
+    results = []
+    for jobs in jobs_values:
+        samples = {run: [] for run in RUNS}
+        for _ in range(repeat):
+            shutil.rmtree(workspace, ignore_errors=True)
+            for run in RUNS:
+                samples[run].append(run_gitaggregate(config_path, jobs))
+        for run in RUNS:
+            result = {"jobs": jobs, "run": run}
+            for key in samples[run][0]:
+                result[key] = statistics.median(s[key] for s in samples[run])
+            results.append(result)
+            print("-j %-3d %-5s %8.2fs %6d subprocesses %8d KiB" % (
+                jobs, run, result["wall_seconds"], result["subprocesses"],
+                result["peak_rss_kib"]))
+    return results
+
+
+def describe():
+    """Describe the code and the environment being benchmarked."""
+    try:
+        version = git(
+            "describe", "--always", "--dirty", cwd=SOURCE_DIR,
+        ).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        version = "unknown"
+    return {
+        "version": version,
+        "git": git("--version").decode().strip(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def compare(results, reference):
+    """Print the ratio of ``results`` over the ``reference`` results."""
+    print("Compared to %s:" % reference["environment"]["version"])
+    reference = {(r["jobs"], r["run"]): r for r in reference["results"]}
+    for result in results:
+        ref = reference.get((result["jobs"], result["run"]))
+        if ref is None:
+            continue
+        print("-j %-3d %-5s" % (result["jobs"], result["run"]), " ".join(
+            "%s x%.2f" % (key, result[key] / ref[key])
+            for key in ("wall_seconds", "subprocesses", "peak_rss_kib")
+            if ref[key]
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repos", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=200)
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--prs", type=int, default=10)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4])
+    parser.add_argument(
+        "--repeat", type=int, default=1,
+        help="Runs of each measure, the median of which is reported.")
+    parser.add_argument(
+        "--rtt", type=float, default=None,
+        help="Serve the upstreams with git daemon, behind a proxy adding\n"
+             "this round trip time, in milliseconds.")
+    parser.add_argument(
+        "--bandwidth", type=float, default=None,
+        help="Bandwidth of each connection to the upstreams served with\n"
+             "--rtt, in KiB/s.")
+    parser.add_argument("--output", help="Write the results to this file.")
+    parser.add_argument(
+        "--compare", help="Compare the results with this results file.")
+    args = parser.parse_args()
+
+    sandbox = tempfile.mkdtemp(prefix="bench_aggregate")
+    try:
+        with contextlib.ExitStack() as stack:
+            remote = None
+            if args.rtt is not None:
+                upstreams = os.path.join(sandbox, "upstreams")
+                os.makedirs(upstreams)
+                remote = stack.enter_context(SlowRemote(
+                    upstreams, args.rtt / 1000,
+                    args.bandwidth and args.bandwidth * 1024))
+            config_path = make_fixtures(
+                sandbox, args.repos, args.depth, args.files, args.prs, remote)
+            results = bench(config_path, args.jobs, args.repeat)
+    finally:
+        shutil.rmtree(sandbox)
+    report = {
+        "environment": describe(),
+        "parameters": {
+            key: getattr(args, key)
+            for key in (
+                "repos", "depth", "files", "prs", "jobs", "repeat", "rtt",
+                "bandwidth",
+            )
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
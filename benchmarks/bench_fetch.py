@@ -0,0 +1,102 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+"""Compare batched fetch with one fetch per merge.
+
+Builds a local upstream with many branches, then aggregates all of them
+from the same remote, once with :meth:`Repo.fetch` and once with the
+historical one ``git fetch`` per merge strategy.
+
+Usage::
+
+    python benchmarks/bench_fetch.py [--merges 40]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from git_aggregator.repo import Repo
+
+
+class PerMergeFetchRepo(Repo):
+    """Repo fetching each merge with its own ``git fetch``."""
+
+    def fetch(self):
+        for merge in self.merges:
+            cmd = ("git", "fetch") + self._fetch_options(merge) + (
+                merge["remote"],
+                "+%s:%s" % (merge["ref"], self._local_ref(
+                    merge["remote"], merge["ref"])),
+            )
+            self.log_call(cmd, cwd=self.cwd)
+
+
+class CountingMixin:
+    """Count subprocesses run through ``log_call``."""
+
+    calls = 0
+
+    def log_call(self, cmd, *args, **kw):
+        self.calls += 1
+        return super().log_call(cmd, *args, **kw)
+
+
+def git(*args, cwd=None):
+    subprocess.check_call(
+        ("git",) + args, cwd=cwd,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_upstream(path, branches):
+    """Create a repo with ``branches`` branches, each adding one file."""
+    git("init", "-q", "-b", "master", path)
+    with open(os.path.join(path, "base"), "w") as f:
+        f.write("base\n")
+    git("add", "base", cwd=path)
+    git("commit", "-q", "-m", "base", cwd=path)
+    for i in range(branches):
+        git("checkout", "-q", "-b", "pr%d" % i, "master", cwd=path)
+        with open(os.path.join(path, "file%d" % i), "w") as f:
+            f.write("%d\n" % i)
+        git("add", "file%d" % i, cwd=path)
+        git("commit", "-q", "-m", "pr %d" % i, cwd=path)
+    git("checkout", "-q", "master", cwd=path)
+
+
+def bench(repo_class, sandbox, url, merges_count):
+    cwd = os.path.join(sandbox, repo_class.__name__)
+    merges = [{"remote": "up", "ref": "master"}] + [
+        {"remote": "up", "ref": "pr%d" % i} for i in range(merges_count)
+    ]
+    klass = type(repo_class.__name__, (CountingMixin, repo_class), {})
+    repo = klass(
+        cwd, [{"name": "up", "url": url}], merges,
+        {"remote": "up", "branch": "agg"},
+    )
+    start = time.perf_counter()
+    repo.aggregate()
+    return time.perf_counter() - start, repo.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--merges", type=int, default=40)
+    args = parser.parse_args()
+
+    sandbox = tempfile.mkdtemp(prefix="bench_fetch")
+    try:
+        upstream = os.path.join(sandbox, "upstream")
+        make_upstream(upstream, args.merges)
+        url = "file://" + upstream
+        for repo_class in (PerMergeFetchRepo, Repo):
+            duration, calls = bench(repo_class, sandbox, url, args.merges)
+            print("%-20s %4d subprocesses %8.2fs" % (
+                repo_class.__name__, calls, duration))
+    finally:
+        shutil.rmtree(sandbox)
+
+
+if __name__ == "__main__":
+    main()
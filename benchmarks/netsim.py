@@ -0,0 +1,200 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+"""Serve local repositories as a slow git remote.
+
+Repositories of a directory are served by ``git daemon`` behind a TCP proxy
+adding latency and limiting bandwidth, to reproduce the network round trips
+to a hosting service without leaving the machine.
+
+Usage::
+
+    python benchmarks/netsim.py DIR [--rtt 100] [--bandwidth 1000]
+
+serves the repos of ``DIR`` on ``git://127.0.0.1:<port>/<repo>``, until
+interrupted.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import threading
+import time
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class SlowRemote:
+    """Serve the git repos of ``base_path`` over a slow network.
+
+    Every byte takes half of ``rtt`` to cross the proxy, in each direction,
+    and the bandwidth of each direction of a connection is limited to
+    ``bandwidth`` bytes per second. Opening a connection costs one round
+    trip, as a TCP handshake would.
+
+    Use it as a context manager::
+
+        with SlowRemote(path, rtt=0.1) as remote:
+            url = remote.url("repo.git")
+    """
+
+    def __init__(self, base_path, rtt=0.1, bandwidth=None):
+        self.base_path = os.path.abspath(base_path)
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.port = None
+        self._daemon = None
+        self._daemon_port = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="netsim", daemon=True)
+        self._server = None
+        self._connections = set()
+
+    def url(self, repo):
+        return "git://127.0.0.1:%d/%s" % (self.port, repo)
+
+    def __enter__(self):
+        self._daemon_port = free_port()
+        # like hosting services, allow partial clones and fetching by sha
+        env = dict(
+            os.environ,
+            GIT_CONFIG_COUNT="2",
+            GIT_CONFIG_KEY_0="uploadpack.allowFilter",
+            GIT_CONFIG_VALUE_0="true",
+            GIT_CONFIG_KEY_1="uploadpack.allowAnySHA1InWant",
+            GIT_CONFIG_VALUE_1="true",
+        )
+        self._daemon = subprocess.Popen(
+            ["git", "daemon", "--export-all", "--reuseaddr",
+             "--listen=127.0.0.1", "--port=%d" % self._daemon_port,
+             "--base-path=%s" % self.base_path, self.base_path],
+            env=env, stderr=subprocess.DEVNULL)
+        self._wait_daemon()
+        self._thread.start()
+        self.port = asyncio.run_coroutine_threadsafe(
+            self._start(), self._loop).result()
+        return self
+
+    def __exit__(self, *exc_args):
+        asyncio.run_coroutine_threadsafe(self._stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._daemon.terminate()
+        self._daemon.wait()
+
+    def _wait_daemon(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(
+                    ("127.0.0.1", self._daemon_port), timeout=1).close()
+                return
+            except OSError:
+                if self._daemon.poll() is not None:
+                    raise RuntimeError("git daemon did not start")
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    async def _start(self):
+        self._server = await asyncio.start_server(
+            self._handle, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def _stop(self):
+        self._server.close()
+        if self._connections:
+            # let the last answers reach their clients
+            await asyncio.wait(self._connections, timeout=self.rtt + 1)
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _handle(self, client_reader, client_writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        task.add_done_callback(self._connections.discard)
+        await asyncio.sleep(self.rtt)
+        try:
+            daemon_reader, daemon_writer = await asyncio.open_connection(
+                "127.0.0.1", self._daemon_port)
+        except OSError:
+            client_writer.close()
+            return
+        upload = asyncio.ensure_future(
+            self._pipe(client_reader, daemon_writer))
+        try:
+            # the connection is over once the server is done answering
+            await self._pipe(daemon_reader, client_writer)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            upload.cancel()
+            daemon_writer.close()
+            client_writer.close()
+
+    async def _pipe(self, reader, writer):
+        """Forward data from ``reader`` to ``writer``, late and slowly.
+
+        Chunks are read as soon as they arrive and delivered half a round
+        trip later, so that latency does not add up with the bandwidth
+        limit or with the size of the transfer.
+        """
+        queue = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                delay = due - self._loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not data:
+                    writer.write_eof()
+                    break
+                writer.write(data)
+                await writer.drain()
+                if self.bandwidth:
+                    await asyncio.sleep(len(data) / self.bandwidth)
+
+        delivery = asyncio.ensure_future(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                queue.put_nowait((self._loop.time() + self.rtt / 2, data))
+                if not data:
+                    break
+            await delivery
+        except OSError:
+            pass
+        finally:
+            delivery.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("base_path", help="Directory of the repos to serve.")
+    parser.add_argument(
+        "--rtt", type=float, default=100,
+        help="Round trip time, in milliseconds.")
+    parser.add_argument(
+        "--bandwidth", type=float, default=None,
+        help="Bandwidth of each connection, in KiB/s, unlimited if omitted.")
+    args = parser.parse_args()
+    bandwidth = args.bandwidth and args.bandwidth * 1024
+    with SlowRemote(args.base_path, args.rtt / 1000, bandwidth) as remote:
+        print("Serving %s on %s" % (remote.base_path, remote.url("")))
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@
 
 import logging
 import os
+import re
 from string import Template
 
 import yaml
@@ -12,6 +13,9 @@ from .exception import ConfigException
 
 log = logging.getLogger(__name__)
 
+# partial clone filters supported in the defaults
+FILTER_RE = re.compile(r'^(blob:none|blob:limit=[0-9]+[kmg]?|tree:0)$')
+
 
 def get_repos(config, force=False):
     """Return a :py:obj:`list` list of repos from config file.
@@ -29,6 +33,11 @@ def get_repos(config, force=False):
             'defaults': repo_data.get('defaults', dict()),
             'force': force,
         }
+        clone_filter = repo_dict['defaults'].get('filter')
+        if clone_filter and not FILTER_RE.match(str(clone_filter)):
+            raise ConfigException(
+                '%s: Filter must be blob:none, blob:limit=<n>, tree:0 or '
+                'false, not %s.' % (directory, clone_filter))
         remote_names = set()
         if 'remotes' in repo_data:
             repo_dict['remotes'] = []
@@ -86,6 +95,14 @@ def get_repos(config, force=False):
         else:
             raise ConfigException(
                 '%s: merges is not defined.' % directory)
+        if 'sparse' in repo_data:
+            sparse = repo_data['sparse'] or []
+            if isinstance(sparse, string_types):
+                sparse = [sparse]
+            repo_dict['sparse'] = [str(directory) for directory in sparse]
+        # The mirror cache, if enabled, can be disabled for the repo
+        if 'mirror' in repo_data:
+            repo_dict['mirror'] = bool(repo_data['mirror'])
         # Only fetch required remotes by default
         repo_dict["fetch_all"] = repo_data.get("fetch_all", False)
         if isinstance(repo_dict["fetch_all"], string_types):
@@ -130,6 +147,75 @@ def get_repos(config, force=False):
     return repo_list
 
 
+def get_lock_path(config):
+    """Return the path of the lock file of a config file.
+
+    >>> get_lock_path('repos.yaml')
+    'repos.lock.yaml'
+    """
+    return os.path.splitext(config)[0] + '.lock.yaml'
+
+
+def _lock_key(directory):
+    """Key of a repo in the lock file: its directory, relative to the
+    current one like in config files if possible."""
+    relpath = os.path.relpath(directory)
+    if relpath.startswith(os.pardir):
+        return directory
+    return relpath
+
+
+def write_lock(lock_path, locked_repos):
+    """Write the shas of the merges of repos in a lock file.
+
+    Repos already in the lock file but not in ``locked_repos`` are kept.
+
+    :param lock_path: path to the lock file.
+    :param locked_repos: mapping of repo directories to their merges, with
+                         their ``sha`` key.
+    """
+    lock = {}
+    if os.path.exists(lock_path):
+        with open(lock_path) as lock_file:
+            lock = yaml.load(lock_file, Loader=yaml.SafeLoader) or {}
+    for directory, merges in locked_repos.items():
+        lock[_lock_key(directory)] = [
+            {'remote': m['remote'], 'ref': m['ref'], 'sha': m['sha']}
+            for m in merges
+        ]
+    with open(lock_path, 'w') as lock_file:
+        yaml.safe_dump(lock, lock_file, default_flow_style=False)
+
+
+def apply_lock(repos, lock_path):
+    """Pin the merges of repos to the shas of a lock file.
+
+    Each merge gets a ``sha`` key, and each repo is flagged as ``frozen``.
+
+    :param repos: repos, as returned by :func:`get_repos`.
+    :param lock_path: path to the lock file.
+    """
+    if not os.path.exists(lock_path):
+        raise ConfigException('Unable to find lock file: %s' % lock_path)
+    with open(lock_path) as lock_file:
+        lock = yaml.load(lock_file, Loader=yaml.SafeLoader) or {}
+    lock = {os.path.abspath(k): v for k, v in lock.items()}
+    for repo_dict in repos:
+        directory = repo_dict['cwd']
+        if directory not in lock:
+            raise ConfigException(
+                '%s: Not found in lock file %s.' % (directory, lock_path))
+        locked = lock[directory]
+        if [(m['remote'], m['ref']) for m in locked] != [
+                (m['remote'], m['ref']) for m in repo_dict['merges']]:
+            raise ConfigException(
+                '%s: Merges differ from lock file %s, it must be updated.'
+                % (directory, lock_path))
+        for merge, locked_merge in zip(repo_dict['merges'], locked):
+            merge['sha'] = locked_merge['sha']
+        repo_dict['frozen'] = True
+
+
 def load_config(config, expand_env=False, env_file=None, force=False):
     """Return repos from a directory and fnmatch. Not recursive.
 
@@ -16,3 +16,7 @@ class ConfigException(GitAggregatorException):
 
 class DirtyException(GitAggregatorException):
     """Repo directory is dirty"""
+
+
+class CancelledException(GitAggregatorException):
+    """Command cancelled because the run is aborted"""
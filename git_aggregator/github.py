@@ -0,0 +1,499 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+GITHUB_API_URL = 'https://api.github.com'
+DEFAULT_CONCURRENCY = 8
+CACHE_TTL = 300
+CACHE_MAX_SIZE = 50 * 1024 * 1024
+GRAPHQL_BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+# GitHub asks to wait at least a minute after a secondary rate limit that
+# does not say how long to wait
+SECONDARY_RATE_LIMIT_WAIT = 60
+PULL_FIELDS = 'state url labels(first: 100) { nodes { name } }'
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def default_cache_dir():
+    """Return the directory where GitHub responses are cached by default.
+    """
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'git-aggregator', 'github',
+    )
+
+
+def is_final(data):
+    """Tell if an API resource will not change anymore.
+
+    Pull requests and issues that are closed, merged or not, are not
+    expected to move again.
+    """
+    return isinstance(data, dict) and data.get('state') == 'closed'
+
+
+class ResponseCache:
+    """Disk cache of successful API responses, keyed by url.
+
+    Each response is stored in its own file, with its validators (``ETag``
+    and ``Last-Modified``) to revalidate it with a conditional request once
+    it is older than ``ttl`` seconds. Responses of final resources (see
+    :func:`is_final`) never expire. When the cache grows over ``max_size``
+    bytes, the least recently used responses are evicted.
+    """
+
+    def __init__(self, path, ttl=CACHE_TTL, max_size=CACHE_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def _entry_path(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key + '.json')
+
+    def load(self, url):
+        """Return the cached entry of ``url``, or ``None``."""
+        try:
+            with open(self._entry_path(url)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == url else None
+
+    def is_fresh(self, entry):
+        return entry['final'] or time.time() - entry['stored'] < self.ttl
+
+    def store(self, url, response):
+        """Cache the successful ``response`` of ``url``."""
+        self._write(url, {
+            'url': url,
+            'stored': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'final': is_final(response.json()),
+            'body': response.text,
+        })
+
+    def refresh(self, url, entry):
+        """Mark ``entry`` as fresh again, after a successful revalidation.
+        """
+        entry['stored'] = time.time()
+        self._write(url, entry)
+
+    def touch(self, url):
+        """Record a use of the entry of ``url``, for the eviction."""
+        try:
+            os.utime(self._entry_path(url))
+        except OSError:
+            pass
+
+    def _write(self, url, entry):
+        os.makedirs(self.path, exist_ok=True)
+        path = self._entry_path(url)
+        tmp_path = '%s.%d.%d.tmp' % (
+            path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def prune(self):
+        """Evict the least recently used entries, down to ``max_size``."""
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        entries = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        size = sum(e[1] for e in entries)
+        for __, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            size -= entry_size
+
+
+def cached_response(url, entry):
+    """Build a :class:`requests.Response` from a cache entry."""
+    response = requests.Response()
+    response.url = url
+    response.status_code = 200
+    response.reason = 'OK'
+    response.encoding = 'utf-8'
+    response._content = entry['body'].encode('utf-8')
+    return response
+
+
+def pulls_query(pulls):
+    """Build a GraphQL query of the ``(owner, repo, number)`` ``pulls``.
+
+    Repositories and pull requests are aliased, as ``r<i>`` and
+    ``p<number>``.
+
+    :return: the query, and the mapping of the aliases of each repository
+             to its ``(owner, repo)``
+    """
+    repos = {}
+    for owner, repo, number in pulls:
+        repos.setdefault((owner, repo), set()).add(int(number))
+    lines = ['query {']
+    aliases = {}
+    for i, ((owner, repo), numbers) in enumerate(sorted(repos.items())):
+        aliases['r%d' % i] = (owner, repo)
+        lines.append('  r%d: repository(owner: %s, name: %s) {' % (
+            i, json.dumps(owner), json.dumps(repo)))
+        lines.extend(
+            '    p%d: pullRequest(number: %d) { %s }' % (
+                number, number, PULL_FIELDS)
+            for number in sorted(numbers)
+        )
+        lines.append('  }')
+    lines.append('}')
+    return '\n'.join(lines), aliases
+
+
+def rest_pull(node):
+    """Convert a GraphQL pull request to the REST fields we use."""
+    return {
+        'state': 'open' if node['state'] == 'OPEN' else 'closed',
+        'merged': node['state'] == 'MERGED',
+        'html_url': node['url'],
+        'labels': [
+            {'name': label['name']} for label in node['labels']['nodes']
+        ],
+    }
+
+
+class RateLimiter:
+    """Schedule API requests within the rate limits of GitHub.
+
+    Each request takes one of the ``tokens``, the one with the most
+    requests left, and waits for the reset of their rate limit windows when
+    they are all exhausted. The quota of a token is updated from the
+    ``X-RateLimit-Remaining`` and ``X-RateLimit-Reset`` headers of its
+    responses, and a token answered with ``Retry-After`` is not used before
+    the given delay.
+
+    At most ``concurrency`` requests run at the same time. The concurrency
+    is halved each time GitHub rate limits a request, and grows back by one
+    every ``concurrency`` successful requests.
+    """
+
+    def __init__(self, tokens, concurrency):
+        self.max_concurrency = max(concurrency, 1)
+        self.concurrency = self.max_concurrency
+        self._cond = threading.Condition()
+        self._running = 0
+        self._successes = 0
+        self._tokens = [
+            # remaining is unknown until the first response
+            {
+                'token': token,
+                'remaining': None,
+                'reset': 0,
+                'until': 0,
+                'pending': 0,
+            }
+            for token in tokens or [None]
+        ]
+
+    def _available(self, state, now):
+        if state['until'] > now:
+            return False
+        if state['reset'] <= now:
+            state['remaining'] = None
+        return (
+            state['remaining'] is None
+            or state['remaining'] > state['pending']
+        )
+
+    def acquire(self):
+        """Wait until a request can be sent.
+
+        :return: the token to send it with, to give back to :meth:`release`
+        """
+        with self._cond:
+            while True:
+                now = time.time()
+                available = [
+                    s for s in self._tokens if self._available(s, now)]
+                if available and self._running < self.concurrency:
+                    state = max(available, key=lambda s: (
+                        s['remaining'] is None,
+                        (s['remaining'] or 0) - s['pending'],
+                    ))
+                    state['pending'] += 1
+                    self._running += 1
+                    return state
+                timeout = None
+                if not available:
+                    timeout = max(min(
+                        max(s['until'], s['reset']) for s in self._tokens
+                    ) - now, 0.1)
+                    if not self._running:
+                        logger.warning(
+                            'GitHub rate limit reached, waiting %ds',
+                            timeout)
+                self._cond.wait(timeout)
+
+    def release(self, state, response):
+        """Account for the ``response`` to a request sent with ``state``.
+
+        :param response: the :class:`requests.Response`, or ``None`` if
+                         the request failed
+        :return: ``True`` if the request was rate limited, and must be
+                 retried
+        """
+        with self._cond:
+            self._running -= 1
+            state['pending'] -= 1
+            self._cond.notify_all()
+            if response is None:
+                return False
+            headers = response.headers
+            now = time.time()
+            if 'X-RateLimit-Remaining' in headers:
+                state['remaining'] = int(headers['X-RateLimit-Remaining'])
+                state['reset'] = int(headers.get('X-RateLimit-Reset', 0))
+            limited = response.status_code == 429 or (
+                response.status_code == 403 and (
+                    state['remaining'] == 0 or 'Retry-After' in headers))
+            if not limited:
+                self._successes += 1
+                if self._successes >= self.concurrency:
+                    self._successes = 0
+                    self.concurrency = min(
+                        self.concurrency + 1, self.max_concurrency)
+                return False
+            if 'Retry-After' in headers:
+                state['until'] = now + int(headers['Retry-After'])
+            elif state['remaining'] != 0:
+                state['until'] = now + SECONDARY_RATE_LIMIT_WAIT
+            if state['remaining'] != 0:
+                # secondary rate limit: we are going too fast
+                self._successes = 0
+                self.concurrency = max(self.concurrency // 2, 1)
+            return True
+
+
+class GithubClient:
+    """Client of the GitHub REST API, shared by all repos of a run.
+
+    Requests go through a single :class:`requests.Session`, so that
+    connections to the API are kept alive and reused, and
+    :meth:`iter_many` runs at most ``concurrency`` requests at the same time.
+
+    :param base_url: url of the API, defaults to the ``GITHUB_API_URL``
+                     environment variable, or to the one of github.com
+    :param tokens: tokens to authenticate with, rotated according to their
+                   rate limits, see :class:`RateLimiter`. Defaults to the
+                   comma separated ``GITHUB_TOKENS``, or to the
+                   ``GITHUB_TOKEN`` environment variable.
+    :param cache: optional :class:`ResponseCache`, to reuse responses of
+                  previous runs
+    """
+
+    def __init__(self, base_url=None, tokens=None,
+                 concurrency=DEFAULT_CONCURRENCY, cache=None):
+        self.base_url = (
+            base_url or os.environ.get('GITHUB_API_URL') or GITHUB_API_URL
+        ).rstrip('/')
+        self.concurrency = max(concurrency, 1)
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if tokens is None:
+            tokens = os.environ.get('GITHUB_TOKENS', '').split(',')
+            tokens = [t.strip() for t in tokens if t.strip()] or [
+                os.environ.get('GITHUB_TOKEN')]
+        self.limiter = RateLimiter(tokens, self.concurrency)
+        self._lock = threading.Lock()
+        self._pulls = {}
+
+    @property
+    def graphql_url(self):
+        # GitHub Enterprise serves REST under /api/v3, GraphQL under /api
+        if self.base_url.endswith('/v3'):
+            return self.base_url[:-len('/v3')] + '/graphql'
+        return self.base_url + '/graphql'
+
+    def request(self, method, url, headers=None, **kw):
+        """Send a request, within the rate limits.
+
+        Rate limited requests are retried, up to :data:`MAX_ATTEMPTS` times.
+
+        :return: the :class:`requests.Response`
+        """
+        for _ in range(MAX_ATTEMPTS):
+            state = self.limiter.acquire()
+            request_headers = dict(headers or {})
+            if state['token']:
+                request_headers['Authorization'] = 'token %s' % state['token']
+            response = None
+            try:
+                response = self.session.request(
+                    method, url, headers=request_headers, **kw)
+            finally:
+                limited = self.limiter.release(state, response)
+            if not limited:
+                break
+            logger.info('Rate limited on %s, retrying', url)
+        return response
+
+    def get(self, path):
+        """GET ``path`` of the API.
+
+        Cached responses are returned as is while they are fresh, and
+        revalidated with a conditional request otherwise: GitHub answers
+        ``304 Not Modified`` without counting it in the rate limit.
+
+        :return: the :class:`requests.Response`
+        """
+        url = self.base_url + path
+        entry = self.cache.load(url) if self.cache else None
+        if entry is None:
+            response = self.request('GET', url)
+        elif self.cache.is_fresh(entry):
+            logger.debug('Cached %s', url)
+            self.cache.touch(url)
+            return cached_response(url, entry)
+        else:
+            headers = {}
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+            response = self.request('GET', url, headers=headers)
+            if response.status_code == 304:
+                logger.debug('Not modified %s', url)
+                self.cache.refresh(url, entry)
+                return cached_response(url, entry)
+        if self.cache and response.status_code == 200:
+            self.cache.store(url, response)
+        return response
+
+    def iter_many(self, paths):
+        """GET all ``paths`` of the API, concurrently.
+
+        Each :class:`requests.Response` is yielded, in the order of
+        ``paths``, as soon as it and the ones of the previous paths are
+        received.
+        """
+        paths = list(paths)
+        if len(paths) <= 1:
+            for path in paths:
+                yield self.get(path)
+        else:
+            workers = min(self.concurrency, len(paths))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                yield from executor.map(self.get, paths)
+        if self.cache:
+            self.cache.prune()
+
+    def graphql(self, query):
+        """Run a GraphQL ``query``.
+
+        :return: the decoded response, with ``data`` and possibly
+                 ``errors``
+        :raise requests.RequestException: if the query could not be run
+        """
+        response = self.request(
+            'POST', self.graphql_url, json={'query': query})
+        response.raise_for_status()
+        return response.json()
+
+    def prefetch_pulls(self, pulls):
+        """Resolve pull requests with batched GraphQL queries.
+
+        Pull requests are deduplicated, and resolved by batches of
+        :data:`GRAPHQL_BATCH_SIZE`, at most ``concurrency`` batches at the
+        same time. Pull requests that could not be resolved are left to
+        the REST API.
+
+        :param pulls: iterable of ``(owner, repo, number)``
+        """
+        keys = {}
+        for owner, repo, number in pulls:
+            keys.setdefault(self._pull_key(owner, repo, number), (
+                owner, repo, int(number)))
+        with self._lock:
+            pulls = [
+                pull for key, pull in sorted(keys.items())
+                if key not in self._pulls
+            ]
+        batches = [
+            pulls[i:i + GRAPHQL_BATCH_SIZE]
+            for i in range(0, len(pulls), GRAPHQL_BATCH_SIZE)
+        ]
+        logger.info(
+            "Resolving %d pull requests in %d GraphQL queries",
+            len(pulls), len(batches))
+        workers = max(min(self.concurrency, len(batches)), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(self._prefetch_batch, batches):
+                pass
+
+    def _prefetch_batch(self, pulls):
+        query, aliases = pulls_query(pulls)
+        try:
+            result = self.graphql(query)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning('Could not query pull requests: %s', e)
+            return
+        for error in result.get('errors') or []:
+            logger.debug('GraphQL error: %s', error.get('message'))
+        data = result.get('data') or {}
+        with self._lock:
+            for alias, (owner, repo) in aliases.items():
+                for name, node in (data.get(alias) or {}).items():
+                    if node:
+                        key = self._pull_key(owner, repo, name[1:])
+                        self._pulls[key] = rest_pull(node)
+
+    @staticmethod
+    def _pull_key(owner, repo, number):
+        # owner and repository names are case insensitive on GitHub
+        return (owner.lower(), repo.lower(), int(number))
+
+    def pull(self, owner, repo, number):
+        """Return a pull request resolved by :meth:`prefetch_pulls`.
+
+        :return: the fields of the pull request, like the REST API returns
+                 them, or ``None``
+        """
+        with self._lock:
+            return self._pulls.get(self._pull_key(owner, repo, number))
+
+
+def default_client():
+    """Return the client shared by the repos that were not given one."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = GithubClient()
+        return _default_client
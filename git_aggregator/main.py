@@ -1,28 +1,37 @@
 # © 2015-2019 ACSONE SA/NV
 # License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
 
+import argparse
+import fnmatch
 import logging
 import os
 import sys
 import threading
+import time
 import traceback
-
-try:
-    from Queue import Empty as EmptyQueue
-    from Queue import Queue
-except ImportError:
-    from queue import Empty as EmptyQueue
-    from queue import Queue
-
-import argparse
-import fnmatch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argcomplete
 import colorama
 
-from .config import load_config
+from .config import apply_lock, get_lock_path, load_config, write_lock
+from .exception import CancelledException
+from .github import (
+    CACHE_TTL,
+    DEFAULT_CONCURRENCY,
+    GithubClient,
+    ResponseCache,
+    default_cache_dir,
+)
 from .log import DebugLogFormatter, LogFormatter
+from .metrics import metrics
+from .mirrors import MIRROR_TTL, MirrorCache
+from .object_store import ObjectStore
+from .remote_refs import RemoteRefsCache
 from .repo import Repo
+from .report import JsonlReport
+from .runner import AsyncGitRunner
+from .tracing import tracer
 from .utils import ThreadNameKeeper
 
 logger = logging.getLogger(__name__)
@@ -122,16 +131,153 @@ def get_parser():
         help='Force cleanup and aggregation on dirty repositories.',
     )
 
+    main_parser.add_argument(
+        '--frozen',
+        dest='frozen',
+        default=False,
+        action='store_true',
+        help='Aggregate the shas pinned in the lock file of the config,\n'
+             'without resolving refs on remotes.',
+    )
+
     main_parser.add_argument(
         '-j', '--jobs',
         dest='jobs',
         default=1,
         type=int,
-        help='Amount of processes to use when aggregating repos. '
-             'This is useful when there are a lot of large repos. '
+        help='Amount of git processes to run in parallel when aggregating '
+             'repos. This is useful when there are a lot of large repos. '
              'Set `1` or less to disable multiprocessing (default).',
     )
 
+    main_parser.add_argument(
+        '--cache-dir',
+        dest='cache_dir',
+        default=None,
+        metavar='DIR',
+        help='Keep bare mirrors of the remotes in DIR, and clone and fetch\n'
+             'the repos from them. Repos still push to their remotes, and\n'
+             'repos configured with "mirror: false" do not use mirrors.\n'
+             'DIR can be shared by concurrent runs.',
+    )
+
+    main_parser.add_argument(
+        '--cache-ttl',
+        dest='cache_ttl',
+        default=MIRROR_TTL,
+        type=int,
+        metavar='SECONDS',
+        help='Refresh the mirrors of --cache-dir that were fetched more\n'
+             'than SECONDS ago (default: %(default)s).',
+    )
+
+    main_parser.add_argument(
+        '--cache-max-size',
+        dest='cache_max_size',
+        default=None,
+        type=int,
+        metavar='MB',
+        help='Once the run is over, evict the least recently used mirrors\n'
+             'of --cache-dir until it takes at most MB megabytes.',
+    )
+
+    main_parser.add_argument(
+        '--object-store',
+        dest='object_store',
+        default=None,
+        metavar='DIR',
+        help='Fetch each remote url once, in a bare repository of DIR,\n'
+             'and make the repos borrow its objects through git alternates\n'
+             'rather than fetching their own copy. Do not remove DIR while\n'
+             'repos borrow from it.',
+    )
+
+    main_parser.add_argument(
+        '--trace',
+        dest='trace',
+        default=None,
+        metavar='FILE',
+        help='Write a timeline of the run to FILE, in the Chrome trace\n'
+             'format, viewable with Perfetto or chrome://tracing.',
+    )
+
+    main_parser.add_argument(
+        '--metrics-file',
+        dest='metrics_file',
+        default=None,
+        metavar='FILE',
+        help='Write metrics of the run to FILE, in the OpenMetrics text\n'
+             'format, e.g. for the textfile collector of node_exporter.',
+    )
+
+    main_parser.add_argument(
+        '--github-concurrency',
+        dest='github_concurrency',
+        default=DEFAULT_CONCURRENCY,
+        type=int,
+        metavar='N',
+        help='Amount of GitHub API requests to run in parallel when\n'
+             'showing pull requests (default: %(default)s).',
+    )
+
+    main_parser.add_argument(
+        '--offline',
+        dest='offline',
+        default=False,
+        action='store_true',
+        help='Tell which pull requests are merged from the commits fetched\n'
+             'by the last aggregation, only querying GitHub for the others.',
+    )
+
+    main_parser.add_argument(
+        '--format',
+        dest='format',
+        default='text',
+        choices=['text', 'jsonl'],
+        help='Format of the pull requests shown by show-all-prs and\n'
+             'show-closed-prs: logged text, or JSON Lines written to the\n'
+             'standard output as soon as each pull request is resolved,\n'
+             'followed by a summary record (default: %(default)s).',
+    )
+
+    main_parser.add_argument(
+        '--github-graphql',
+        dest='github_graphql',
+        default=False,
+        action='store_true',
+        help='Resolve the pull requests of all repos with a few batched\n'
+             'GitHub GraphQL queries, rather than one REST request per\n'
+             'pull request. This requires a GITHUB_TOKEN.',
+    )
+
+    main_parser.add_argument(
+        '--github-cache-dir',
+        dest='github_cache_dir',
+        default=default_cache_dir(),
+        metavar='DIR',
+        help='Directory where GitHub API responses are cached\n'
+             '(default: %(default)s).',
+    )
+
+    main_parser.add_argument(
+        '--github-cache-ttl',
+        dest='github_cache_ttl',
+        default=CACHE_TTL,
+        type=int,
+        metavar='SECONDS',
+        help='Age after which cached GitHub API responses are\n'
+             'revalidated (default: %(default)s). Responses of closed\n'
+             'pull requests never expire.',
+    )
+
+    main_parser.add_argument(
+        '--no-github-cache',
+        dest='github_cache',
+        default=True,
+        action='store_false',
+        help='Do not cache GitHub API responses.',
+    )
+
     main_parser.add_argument(
         '--no-color',
         dest='no_color',
@@ -149,6 +295,14 @@ def get_parser():
         'aggregate',
         help="run the aggregation process (the default if omitted)."
     )
+    sub_parsers.add_parser(
+        'lock',
+        help=(
+            'pin the merges to the shas they currently point to\n'
+            'in a lock file next to the config (repos.lock.yaml\n'
+            'for repos.yaml), to be used with --frozen.'
+        )
+    )
     sub_parsers.add_parser(
         'show-all-prs',
         help=(
@@ -162,6 +316,15 @@ def get_parser():
         'show-closed-prs',
         help="show pull requests that are not open anymore."
     )
+    sub_parsers.add_parser(
+        'check-prs',
+        help=(
+            'show pull requests whose head moved since it was\n'
+            'fetched (or pinned in the lock file with --frozen),\n'
+            'listing the pull requests of each remote at once.\n'
+            'Exits with status 1 if any moved.'
+        )
+    )
 
     return main_parser
 
@@ -213,73 +376,209 @@ def load_aggregate(args):
             r.push()
 
 
-def aggregate_repo(repo, args, sem, err_queue):
+def aggregate_repo(repo, args, report=None):
     """Aggregate one repo according to the args.
 
+    The current thread is named after the repo while it runs, for logging.
+
     Args:
          repo (Repo): The repository to aggregate.
          args (argparse.Namespace): CLI arguments.
+         report (JsonlReport): Report of the pull requests to show, if they
+             are not to be logged.
     """
-    try:
+    with ThreadNameKeeper():
+        threading.current_thread().name = os.path.basename(repo.cwd)
         logger.debug('%s' % repo)
         dirmatch = args.dirmatch
         if not match_dir(repo.cwd, dirmatch):
             logger.info("Skip %s", repo.cwd)
+            metrics.set(repo.cwd, 'status', 'skipped')
             return
-        if args.command == 'aggregate':
-            repo.aggregate()
-            if args.do_push:
-                repo.push()
-        elif args.command == 'show-closed-prs':
-            repo.show_closed_prs()
-        elif args.command == 'show-all-prs':
-            repo.show_all_prs()
-    except Exception:
-        err_queue.put_nowait(sys.exc_info())
-    finally:
-        sem.release()
+        with tracer.span(args.command, 'repo', cwd=repo.cwd), \
+                metrics.measure(repo.cwd) as result:
+            if args.command == 'aggregate':
+                if not repo.aggregate():
+                    result['status'] = 'up_to_date'
+                if args.do_push:
+                    repo.push()
+            elif args.command == 'show-closed-prs':
+                repo.show_closed_prs(offline=args.offline, report=report)
+            elif args.command == 'show-all-prs':
+                repo.show_all_prs(offline=args.offline, report=report)
+
+
+def longest_first(repos):
+    """Sort repos by decreasing expected aggregation duration.
+
+    Starting with the slowest repos avoids waiting for one of them at the
+    end of a parallel run. Repos are expected to take as long as their last
+    run, which is short for the ones found up to date. The duration of
+    repos never aggregated is estimated from their number of merges, and
+    the average duration per merge of the other repos.
+    """
+    durations = {r.cwd: r.expected_duration() for r in repos}
+    known = [r for r in repos if durations[r.cwd] is not None]
+    per_merge = 1.0
+    if known:
+        per_merge = (
+            sum(durations[r.cwd] for r in known) /
+            sum(len(r.merges) for r in known)
+        )
+    for r in repos:
+        if durations[r.cwd] is None:
+            durations[r.cwd] = per_merge * len(r.merges)
+    return sorted(repos, key=lambda r: durations[r.cwd], reverse=True)
+
+
+def aggregate_repos(repos, args, jobs, report=None):
+    """Aggregate repos in parallel.
+
+    Git commands of all repos are run by an :class:`AsyncGitRunner`, so
+    that at most ``jobs`` of them run at the same time. Repos themselves
+    are handled by a pool of ``2 * jobs`` threads, to keep the runner busy
+    while some repos are between two commands. On the first error, running
+    commands are killed, and remaining repos are not started.
+
+    :return: the list of errors, as ``sys.exc_info()`` tuples
+    """
+    errors = []
+    with AsyncGitRunner(jobs) as runner, \
+            ThreadPoolExecutor(max_workers=2 * jobs) as executor:
+        futures = []
+        for repo in repos:
+            repo.runner = runner
+            futures.append(
+                executor.submit(aggregate_repo, repo, args, report))
+        try:
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                exc = future.exception()
+                if exc is None or isinstance(exc, CancelledException):
+                    continue
+                errors.append((type(exc), exc, exc.__traceback__))
+                if not runner.cancelled:
+                    _cancel(runner, futures)
+        except BaseException:
+            _cancel(runner, futures)
+            raise
+    return errors
+
+
+def _cancel(runner, futures):
+    for future in futures:
+        future.cancel()
+    runner.cancel()
 
 
 def run(args):
     """Load YAML and JSON configs and run the command specified
     in args.command"""
-
+    start = time.time()
+    if args.trace:
+        tracer.enable()
+    if args.metrics_file:
+        metrics.enable()
+    mirror_cache = None
+    if args.command == 'aggregate' and args.cache_dir:
+        mirror_cache = MirrorCache(
+            args.cache_dir, ttl=args.cache_ttl,
+            max_size=args.cache_max_size and args.cache_max_size * 1024 ** 2)
+    try:
+        _run(args, mirror_cache)
+    finally:
+        if mirror_cache is not None:
+            mirror_cache.close()
+        if args.trace:
+            logger.info("Writing trace to %s", args.trace)
+            tracer.write(args.trace)
+        if args.metrics_file:
+            logger.info("Writing metrics to %s", args.metrics_file)
+            metrics.write(args.metrics_file, time.time() - start)
+
+
+def _run(args, mirror_cache=None):
+    frozen = args.frozen and args.command != 'lock'
     repos = load_config(
         args.config, args.expand_env, args.env_file, args.force)
+    if frozen:
+        # repos left out by -d may be missing from the lock file
+        apply_lock(
+            [r for r in repos if match_dir(r['cwd'], args.dirmatch)],
+            get_lock_path(args.config))
 
     jobs = max(args.jobs, 1)
-    threads = []
-    sem = threading.Semaphore(jobs)
-    err_queue = Queue()
-
-    for repo_dict in repos:
-        if not err_queue.empty():
-            break
-
-        sem.acquire()
-        r = Repo(**repo_dict)
-        tname = os.path.basename(repo_dict['cwd'])
-
-        if jobs > 1:
-            t = threading.Thread(
-                target=aggregate_repo, args=(r, args, sem, err_queue))
-            t.daemon = True
-            t.name = tname
-            threads.append(t)
-            t.start()
-        else:
-            with ThreadNameKeeper():
-                threading.current_thread().name = tname
-                aggregate_repo(r, args, sem, err_queue)
 
-    for t in threads:
-        t.join()
-
-    if not err_queue.empty():
-        while True:
+    remote_refs = RemoteRefsCache()
+    github = report = None
+    if args.command in ('show-all-prs', 'show-closed-prs'):
+        if args.format == 'jsonl':
+            report = JsonlReport()
+        github = GithubClient(
+            concurrency=args.github_concurrency,
+            cache=args.github_cache and ResponseCache(
+                args.github_cache_dir, ttl=args.github_cache_ttl),
+        )
+    object_store = None
+    if args.command == 'aggregate' and args.object_store:
+        object_store = ObjectStore(args.object_store)
+    repos = [
+        Repo(remote_refs=remote_refs, github=github,
+             object_store=object_store, mirror_cache=mirror_cache,
+             **repo_dict)
+        for repo_dict in repos
+    ]
+    if mirror_cache is not None:
+        # refs are then resolved on the mirrors, without network round trips
+        mirror_cache.refresh_repos(
+            (r for r in repos if match_dir(r.cwd, args.dirmatch)), jobs)
+    if args.command in ('aggregate', 'lock') and not frozen:
+        remote_refs.prefetch_repos(
+            (r for r in repos if match_dir(r.cwd, args.dirmatch)), jobs)
+    if object_store is not None:
+        object_store.prefetch_repos(
+            (r for r in repos if match_dir(r.cwd, args.dirmatch)), jobs)
+    if github and args.github_graphql:
+        github.prefetch_pulls(
+            (pr_info['owner'], pr_info['repo'], pr_info['pr'])
+            for r in repos if match_dir(r.cwd, args.dirmatch)
+            for pr_info in r.pull_requests()
+            if not (args.offline and r.is_merged_offline(pr_info))
+        )
+    if args.command == 'lock':
+        lock_path = get_lock_path(args.config)
+        logger.info("Writing %s", lock_path)
+        write_lock(lock_path, {
+            r.cwd: r.lock() for r in repos if match_dir(r.cwd, args.dirmatch)
+        })
+        return
+    if args.command == 'check-prs':
+        repos = [r for r in repos if match_dir(r.cwd, args.dirmatch)]
+        remote_refs.prefetch_pulls(repos, jobs)
+        moved = [pr_info for r in repos for pr_info in r.show_moved_prs()]
+        if moved:
+            logger.info("%d pull requests moved", len(moved))
+            sys.exit(1)
+        logger.info("No pull request moved")
+        return
+
+    if jobs > 1:
+        if args.command == 'aggregate':
+            repos = longest_first(repos)
+        errors = aggregate_repos(repos, args, jobs, report)
+    else:
+        errors = []
+        for r in repos:
             try:
-                exc_type, exc_obj, exc_trace = err_queue.get_nowait()
-            except EmptyQueue:
+                aggregate_repo(r, args, report)
+            except Exception:
+                errors.append(sys.exc_info())
                 break
+    if report is not None:
+        report.summary()
+
+    if errors:
+        for exc_type, exc_obj, exc_trace in errors:
             traceback.print_exception(exc_type, exc_obj, exc_trace)
         sys.exit(1)
@@ -0,0 +1,148 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .exception import CancelledException
+
+PREFIX = 'gitaggregator_'
+
+REPO_METRICS = (
+    ('duration_seconds', 'Time spent processing the repo.'),
+    ('git_subprocesses', 'Git subprocesses run for the repo.'),
+    ('fetches', 'Git fetch commands run for the repo.'),
+    ('merges', 'Merges applied on top of the first merge of the repo.'),
+)
+
+RUN_METRICS = (
+    ('git_subprocesses',
+     'Git subprocesses run for all repos at once, such as prefetches.'),
+)
+
+STATUSES = ('ok', 'up_to_date', 'skipped', 'failed')
+
+
+def escape_label(value):
+    """Escape a label value for the OpenMetrics text format.
+    >>> escape_label('a"b')
+    'a\\\\"b'
+    """
+    return (
+        value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    )
+
+
+class Metrics:
+    """Collect metrics of a run, per repo, to export them in the
+    OpenMetrics text format.
+
+    All metrics are gauges holding the values of the last run, so that the
+    file can be picked by the textfile collector of node_exporter. Nothing
+    is collected until the metrics are enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._repos = {}
+        self._run = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def inc(self, repo, name, value=1):
+        """Add ``value`` to the metric ``name`` of ``repo``, or of the whole
+        run if ``repo`` is ``None``."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if repo is None:
+                values = self._run
+            else:
+                values = self._repos.setdefault(repo, {})
+            values[name] = values.get(name, 0) + value
+
+    def set(self, repo, name, value):
+        """Set the metric ``name`` of ``repo`` to ``value``."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._repos.setdefault(repo, {})[name] = value
+
+    @contextmanager
+    def measure(self, repo):
+        """Record the duration and the status of the enclosed block.
+
+        The status is ``ok``, unless the block sets another one in the
+        yielded dict, or raises: ``failed`` on error and ``skipped`` if the
+        run was cancelled.
+        """
+        result = {'status': 'ok'}
+        start = time.time()
+        try:
+            yield result
+        except CancelledException:
+            result['status'] = 'skipped'
+            raise
+        except Exception:
+            result['status'] = 'failed'
+            raise
+        finally:
+            self.set(repo, 'duration_seconds', time.time() - start)
+            self.set(repo, 'status', result['status'])
+
+    def format(self, duration):
+        """Return the metrics as OpenMetrics text.
+
+        :param duration: wall time of the whole run, in seconds
+        """
+        with self._lock:
+            repos = sorted(self._repos.items())
+            run = dict(self._run)
+        lines = []
+
+        def add(name, help, samples):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, help))
+            lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+            for labels, value in samples:
+                labels = ','.join(
+                    '%s="%s"' % (k, escape_label(v)) for k, v in labels)
+                if labels:
+                    labels = '{%s}' % labels
+                lines.append('%s%s%s %s' % (PREFIX, name, labels, value))
+
+        for name, help in REPO_METRICS:
+            add('repo_' + name, help, [
+                ((('repo', repo),), values.get(name, 0))
+                for repo, values in repos
+            ])
+        add('repo_status', 'Outcome of the repo, as one sample per status.', [
+            ((('repo', repo), ('status', status)),
+             int(values.get('status') == status))
+            for repo, values in repos
+            for status in STATUSES
+        ])
+        for name, help in RUN_METRICS:
+            add('run_' + name, help, [((), run.get(name, 0))])
+        add('run_duration_seconds', 'Wall time of the run.',
+            [((), duration)])
+        add('run_timestamp_seconds', 'End time of the run.',
+            [((), time.time())])
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, duration):
+        """Write the metrics to ``path``.
+
+        The file is replaced atomically, so that a collector never reads a
+        partial file.
+        """
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.format(duration))
+        os.replace(tmp_path, path)
+
+
+metrics = Metrics()
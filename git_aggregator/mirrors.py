@@ -0,0 +1,178 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import git_call, path_to_url, url_path
+
+logger = logging.getLogger(__name__)
+
+MIRROR_TTL = 300
+# file, in the mirrors, whose modification time is the last refresh
+STAMP_FILE = "gitaggregator-fetched"
+
+
+def dir_size(path):
+    """Total size of the files under ``path``, in bytes."""
+    size = 0
+    for dirpath, __, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class MirrorCache:
+    """Local bare mirrors of remote urls, kept from one run to the next.
+
+    Each remote url is mirrored in its own bare repository under ``path``,
+    refreshed when it is older than ``ttl`` seconds. Repos are cloned and
+    fetched from the mirrors, but still push to the remote urls.
+
+    Concurrent processes can share the cache: mirrors are created and
+    refreshed under an exclusive lock, and a run holds a shared lock on the
+    mirrors it uses until it is closed, so that they are not evicted while
+    in use. On close, the least recently used mirrors are evicted until the
+    cache takes at most ``max_size`` bytes, if given.
+    """
+
+    def __init__(self, path, ttl=MIRROR_TTL, max_size=None):
+        self.path = os.path.abspath(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._used = {}
+
+    def mirror_path(self, url):
+        """Path of the bare repository mirroring ``url``."""
+        return url_path(self.path, url)
+
+    def url(self, url):
+        """Url to clone and fetch ``url`` from: its mirror, if this run
+        uses it, else ``url`` itself."""
+        with self._lock:
+            if url in self._used:
+                return path_to_url(self.mirror_path(url))
+        return url
+
+    def refresh(self, url):
+        """Create or refresh the mirror of ``url``, and use it in this run.
+
+        :return: ``True`` if the mirror is used, ``False`` if ``url`` could
+                 not be mirrored
+        """
+        os.makedirs(self.path, exist_ok=True)
+        path = self.mirror_path(url)
+        use_file = open(path + '.use', 'a')
+        try:
+            fcntl.flock(use_file, fcntl.LOCK_SH)
+            with open(path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                mirrored = self._update(url, path)
+        except BaseException:
+            use_file.close()
+            raise
+        if not mirrored:
+            use_file.close()
+            return False
+        # the modification time of the use file orders the eviction
+        os.utime(use_file.fileno())
+        with self._lock:
+            self._used[url] = use_file
+        return True
+
+    def _update(self, url, path):
+        stamp = os.path.join(path, STAMP_FILE)
+        if os.path.isdir(path):
+            try:
+                age = time.time() - os.path.getmtime(stamp)
+            except OSError:
+                age = None
+            if age is not None and age < self.ttl:
+                logger.debug("Mirror of %s is fresh", url)
+                return True
+            logger.info("Refreshing mirror of %s", url)
+            cmds = [['git', '--git-dir', path, 'fetch', '--quiet', '--prune',
+                     'origin']]
+        else:
+            logger.info("Mirroring %s", url)
+            # like hosting services, allow partial clones and fetching by sha
+            cmds = [
+                ['git', 'clone', '--quiet', '--mirror', path_to_url(url),
+                 path],
+                ['git', '--git-dir', path, 'config',
+                 'uploadpack.allowFilter', 'true'],
+                ['git', '--git-dir', path, 'config',
+                 'uploadpack.allowAnySHA1InWant', 'true'],
+            ]
+        for cmd in cmds:
+            if git_call(cmd):
+                logger.warning("Could not mirror %s", url)
+                return False
+        with open(stamp, 'w'):
+            pass
+        return True
+
+    def refresh_repos(self, repos, jobs=1):
+        """:meth:`refresh` the mirrors of the remotes of ``repos``, ``jobs``
+        at a time, but the ones of repos configured with ``mirror: false``.
+        """
+        urls = []
+        for repo in repos:
+            if not repo.mirror:
+                continue
+            for remote in repo.remotes:
+                if remote['url'] not in urls:
+                    urls.append(remote['url'])
+        logger.info("Using mirrors of %d remotes in %s", len(urls), self.path)
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for _ in executor.map(self.refresh, urls):
+                pass
+
+    def prune(self):
+        """Evict the least recently used mirrors, down to ``max_size``.
+
+        Mirrors in use, by this run or another one, are never evicted.
+        """
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        mirrors = []
+        for name in names:
+            path = os.path.join(self.path, name)
+            if not name.endswith('.git') or not os.path.isdir(path):
+                continue
+            try:
+                last_use = os.path.getmtime(path + '.use')
+            except OSError:
+                last_use = 0
+            mirrors.append((last_use, dir_size(path), path))
+        size = sum(m[1] for m in mirrors)
+        for __, mirror_size, path in sorted(mirrors):
+            if size <= self.max_size:
+                break
+            with open(path + '.use', 'a') as use_file:
+                try:
+                    fcntl.flock(use_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                logger.info("Evicting mirror %s", path)
+                shutil.rmtree(path, ignore_errors=True)
+            size -= mirror_size
+
+    def close(self):
+        """Evict the mirrors over ``max_size``, and release the others."""
+        if self.max_size is not None:
+            self.prune()
+        with self._lock:
+            used, self._used = self._used, {}
+        for use_file in used.values():
+            use_file.close()
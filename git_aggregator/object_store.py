@@ -0,0 +1,161 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from ._compat import console_to_str
+from .repo import DEFAULT_FILTER, FETCH_DEFAULTS, LOCAL_REFS, is_sha
+from .utils import git_call, url_path
+
+logger = logging.getLogger(__name__)
+
+
+class ObjectStore:
+    """Bare repositories sharing the objects of remotes between repos.
+
+    Each distinct remote url is fetched once, in its own bare repository
+    under ``path``, and the repos borrow the objects of the stores of their
+    remotes through git alternates, rather than fetching and storing their
+    own copy.
+
+    Stores are partial clones with the ``filter`` of the repos borrowing
+    from them, so that they do not download the files of the whole history.
+    The files the repos check out are thus not shared: each repo fetches
+    them from its remotes, like any partial clone. Repos with different
+    filters use different stores.
+
+    Garbage collection is disabled in the stores: pruning the objects that
+    are not referenced by a store anymore would corrupt the repos borrowing
+    them. Shallow repos, with a ``depth``, ``shallow-since`` or
+    ``shallow-exclude`` default or merge option, do not use the stores, as
+    shallow histories cannot be shared.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def store_path(self, url, clone_filter=None):
+        """Path of the bare repository storing the objects of ``url``, as
+        fetched with the partial clone filter ``clone_filter``."""
+        if clone_filter:
+            url = '%s#%s' % (url, clone_filter)
+        return url_path(self.path, url)
+
+    @staticmethod
+    def is_shallow(repo):
+        return any(
+            repo.defaults.get(option)
+            or any(merge.get(option) for merge in repo.merges)
+            for option in FETCH_DEFAULTS)
+
+    @staticmethod
+    def clone_filter(repo):
+        """Partial clone filter of the stores ``repo`` borrows from."""
+        return repo.defaults.get('filter', DEFAULT_FILTER) or None
+
+    def references(self, repo):
+        """Paths of the existing stores of the remotes of ``repo``."""
+        if self.is_shallow(repo):
+            return []
+        paths = []
+        for remote in repo.remotes:
+            path = self.store_path(remote['url'], self.clone_filter(repo))
+            if os.path.isdir(path) and path not in paths:
+                paths.append(path)
+        return paths
+
+    def prefetch(self, url, refs, clone_filter=None):
+        """Fetch ``refs`` of ``url`` in its store, creating it if needed.
+
+        :param refs: mapping of the refs to the shas they are expected to
+                     point to, ``None`` if unknown. Nothing is fetched if
+                     the store has all these shas already.
+        :param clone_filter: partial clone filter of the store
+        """
+        path = self.store_path(url, clone_filter)
+        cmds = []
+        if not os.path.isdir(path):
+            cmds.append(['git', 'init', '--quiet', '--bare', path])
+            cmds.append(['git', '--git-dir', path, 'config', 'gc.auto', '0'])
+            if clone_filter:
+                # like git clone --filter, for the store to be a partial clone
+                cmds += [
+                    ['git', '--git-dir', path, 'config', key, value]
+                    for key, value in (
+                        ('remote.origin.url', url),
+                        ('remote.origin.promisor', 'true'),
+                        ('remote.origin.partialclonefilter', clone_filter),
+                    )
+                ]
+        elif self._has_commits(path, refs.values()):
+            logger.debug("Object store of %s is up to date", url)
+            return
+        cmd = ['git', '--git-dir', path, 'fetch', '--quiet', '--no-tags']
+        if clone_filter:
+            cmd += ['--filter=%s' % clone_filter, 'origin']
+        else:
+            cmd.append(url)
+        cmds.append(cmd + [
+            '+%s:%s%s' % (ref, LOCAL_REFS, ref) for ref in sorted(refs)])
+        for cmd in cmds:
+            if git_call(cmd):
+                logger.warning(
+                    "Could not fetch %s in the object store", url)
+                return
+
+    @staticmethod
+    def _has_commits(path, shas):
+        """Tell if the store at ``path`` has all ``shas``.
+
+        Unlike ``cat-file``, ``rev-list --missing=print`` does not fetch
+        the objects missing from the store from its promisor remote.
+        """
+        shas = list(shas)
+        if None in shas:
+            return False
+        out = git_call(
+            ['git', '--git-dir', path, 'rev-list', '--no-walk', '--objects',
+             '--filter=tree:0', '--missing=print', '--ignore-missing']
+            + shas,
+            callwith=subprocess.check_output)
+        found = {line.split()[0] for line in console_to_str(out).splitlines()}
+        return found.issuperset(shas)
+
+    def prefetch_repos(self, repos, jobs=1):
+        """:meth:`prefetch` the merges of ``repos``, ``jobs`` urls at a time.
+
+        Merges pinned to a sha are left to the fetch of the repos. The
+        others are resolved on their remotes, or with their lock file sha,
+        so that the stores are only fetched when merges moved.
+        """
+        refs = {}
+        for repo in repos:
+            if self.is_shallow(repo):
+                continue
+            urls = {r['name']: r['url'] for r in repo.remotes}
+            for merge in repo.merges:
+                if is_sha(merge['ref']):
+                    continue
+                url = urls[merge['remote']]
+                refs.setdefault((url, self.clone_filter(repo)), {})[
+                    merge['ref']] = self._resolve(repo, url, merge)
+        logger.info(
+            "Fetching %d remotes in the object store %s",
+            len(refs), self.path)
+        os.makedirs(self.path, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for (url, clone_filter), url_refs in refs.items():
+                executor.submit(self.prefetch, url, url_refs, clone_filter)
+
+    @staticmethod
+    def _resolve(repo, url, merge):
+        """Sha ``merge`` of ``repo`` points to, ``None`` if unknown."""
+        if merge.get('sha'):
+            return merge['sha']
+        try:
+            rtype, sha = repo.query_remote_ref(url, merge['ref'])
+        except subprocess.CalledProcessError:
+            return None
+        return sha if rtype is not None else None
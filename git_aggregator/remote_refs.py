@@ -0,0 +1,119 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import logging
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ._compat import console_to_str
+from .repo import is_sha, parse_ls_remote
+from .utils import git_call
+
+logger = logging.getLogger(__name__)
+
+
+def match_pattern(fullref, pattern):
+    """Tell if ``git ls-remote`` would list ``fullref`` for ``pattern``.
+    >>> match_pattern('refs/heads/8.0', '8.0')
+    True
+    >>> match_pattern('refs/heads/18.0', '8.0')
+    False
+    """
+    return fullref == pattern or fullref.endswith('/' + pattern)
+
+
+class RemoteRefsCache:
+    """Cache of ``git ls-remote`` results, shared by all repos of a run.
+
+    Results are stored by remote url, together with the patterns that were
+    queried, so that a cached url can still be queried for other refs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refs = {}
+        self._patterns = {}
+
+    def get(self, url, pattern):
+        """Return the cached ``(sha, fullref)`` matching ``pattern``.
+
+        :return: a list, possibly empty, or ``None`` if ``pattern`` was never
+                 queried on ``url``
+        """
+        with self._lock:
+            if pattern not in self._patterns.get(url, ()):
+                return None
+            return [
+                (sha, fullref)
+                for fullref, sha in self._refs[url].items()
+                if match_pattern(fullref, pattern)
+            ]
+
+    def update(self, url, patterns, refs):
+        """Store the ``refs`` listed by querying ``patterns`` on ``url``."""
+        with self._lock:
+            self._patterns.setdefault(url, set()).update(patterns)
+            self._refs.setdefault(url, {}).update(
+                (fullref, sha) for sha, fullref in refs)
+
+    def prefetch(self, url, patterns, listed=None):
+        """Query all ``patterns`` on ``url`` with a single ``ls-remote``.
+
+        :param listed: optional patterns to list instead, such as
+                       ``refs/pull/*/head``, covering all ``patterns``
+        """
+        try:
+            out = git_call(
+                ['git', 'ls-remote', url] + sorted(listed or patterns),
+                callwith=subprocess.check_output)
+        except subprocess.CalledProcessError:
+            logger.warning("Could not list refs of %s", url)
+            return
+        self.update(url, patterns, parse_ls_remote(console_to_str(out)))
+
+    def prefetch_repos(self, repos, jobs=1):
+        """Resolve the target and merge refs of ``repos``.
+
+        One ``git ls-remote`` is issued per distinct remote url, running
+        at most ``jobs`` of them in parallel. Remotes fetched from a mirror
+        are left out, their refs are resolved on the mirror.
+
+        :param repos: iterable of :class:`~git_aggregator.repo.Repo`
+        """
+        patterns = {}
+        for repo in repos:
+            urls = {
+                r['name']: r['url'] for r in repo.remotes
+                if repo.fetch_url(r['url']) == r['url']
+            }
+            if repo.target['remote'] in urls:
+                patterns.setdefault(urls[repo.target['remote']], set()).add(
+                    repo.target['branch'])
+            for merge in repo.merges:
+                if merge['remote'] in urls and not is_sha(merge['ref']):
+                    patterns.setdefault(urls[merge['remote']], set()).add(
+                        merge['ref'])
+        logger.info("Resolving refs of %d remotes", len(patterns))
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for url, url_patterns in patterns.items():
+                executor.submit(self.prefetch, url, url_patterns)
+
+    def prefetch_pulls(self, repos, jobs=1):
+        """Resolve the GitHub pull request merges of ``repos``.
+
+        All the pull requests heads of each remote are listed at once, with
+        one ``git ls-remote <url> refs/pull/*/head`` per distinct url.
+
+        :param repos: iterable of :class:`~git_aggregator.repo.Repo`
+        """
+        patterns = {}
+        for repo in repos:
+            urls = {r['name']: r['url'] for r in repo.remotes}
+            for pr_info in repo.pull_requests():
+                patterns.setdefault(urls[pr_info['remote']], set()).add(
+                    pr_info['ref'])
+        logger.info("Listing pull requests of %d remotes", len(patterns))
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for url, url_patterns in patterns.items():
+                executor.submit(
+                    self.prefetch, url, url_patterns, ['refs/pull/*/head'])
@@ -2,17 +2,41 @@
 # License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
 # Parts of the code comes from ANYBOX
 # https://github.com/anybox/anybox.recipe.odoo
+import hashlib
+import json
 import logging
 import os
 import re
 import subprocess
-
-import requests
+import time
 
 from ._compat import console_to_str
-from .exception import DirtyException, GitAggregatorException
+from .exception import (
+    CancelledException,
+    DirtyException,
+    GitAggregatorException,
+)
+from .github import default_client
+from .metrics import metrics
+from .tracing import tracer
 
 FETCH_DEFAULTS = ("depth", "shallow-since", "shallow-exclude")
+# partial clone filter of new repos, unless set in the defaults
+DEFAULT_FILTER = "blob:none"
+# depth value deepening the history only as far as the merges need
+ADAPTIVE_DEPTH = "auto"
+# depth of the first fetch of repos with an adaptive depth
+ADAPTIVE_DEPTH_START = 50
+# depth beyond which an adaptive depth gives up finding merge bases
+ADAPTIVE_DEPTH_MAX = 1 << 20
+# namespace where merge refs are fetched
+LOCAL_REFS = "refs/gitaggregator/"
+# namespace where intermediate merges are cached
+CACHE_REFS = "refs/gitaggregator-cache/"
+# maximum number of intermediate merges cached per repository
+PREFIX_CACHE_SIZE = 100
+# file, in the .git directory, where the state of the last run is stored
+STATE_FILE = "gitaggregator.json"
 logger = logging.getLogger(__name__)
 
 
@@ -30,13 +54,30 @@ def ishex(s):
     return True
 
 
+def is_sha(s):
+    """True iff given string is a full commit sha (SHA-1 or SHA-256).
+    >>> is_sha('6054de2c4e669f85cec380da90d746061967dc83')
+    True
+    >>> is_sha('deadbeef')
+    False
+    """
+    return len(s) in (40, 64) and ishex(s)
+
+
+def parse_ls_remote(out):
+    """Parse ``git ls-remote`` output into a list of ``(sha, fullref)``."""
+    return [tuple(line.split()) for line in out.strip().splitlines()]
+
+
 class Repo:
 
     _git_version = None
 
     def __init__(self, cwd, remotes, merges, target,
                  shell_command_after=None, fetch_all=False, defaults=None,
-                 force=False):
+                 force=False, remote_refs=None, frozen=False, runner=None,
+                 github=None, object_store=None, mirror=True,
+                 mirror_cache=None, sparse=None):
         """Initialize a git repository aggregator
 
         :param cwd: path to the directory where to initialize the repository
@@ -55,6 +96,29 @@ class Repo:
             Collection of default parameters to be passed to git.
         :param bool force:
             When ``False``, it will stop if repo is dirty.
+        :param remote_refs:
+            Optional :class:`~git_aggregator.remote_refs.RemoteRefsCache`
+            shared by all repos, used to answer :meth:`query_remote_ref`.
+        :param bool frozen:
+            When ``True``, merges are pinned to the ``sha`` of a lock file,
+            and refs are never queried on remotes.
+        :param runner:
+            Optional :class:`~git_aggregator.runner.AsyncGitRunner` running
+            the git commands, instead of running them directly.
+        :param github:
+            Optional :class:`~git_aggregator.github.GithubClient` shared by
+            all repos, used to query pull requests.
+        :param object_store:
+            Optional :class:`~git_aggregator.object_store.ObjectStore`
+            shared by all repos, from which objects are borrowed.
+        :param bool mirror:
+            When ``False``, the ``mirror_cache`` is not used.
+        :param mirror_cache:
+            Optional :class:`~git_aggregator.mirrors.MirrorCache` whose
+            mirrors the remotes are cloned and fetched from.
+        :param sparse:
+            Optional list of the directories to check out, in the cone mode
+            of ``git sparse-checkout``, rather than the whole tree.
         """
         self.cwd = cwd
         self.remotes = remotes
@@ -67,6 +131,17 @@ class Repo:
         self.shell_command_after = shell_command_after or []
         self.defaults = defaults or dict()
         self.force = force
+        self.remote_refs = remote_refs
+        self.frozen = frozen
+        self.runner = runner
+        self.github = github or default_client()
+        self.object_store = object_store
+        self.mirror = mirror
+        self.mirror_cache = mirror_cache
+        self.sparse = [d.strip('/') for d in sparse or []]
+        self._depth = None
+        self._merged_refs = None
+        self._state_file = None
 
     @property
     def git_version(self):
@@ -133,19 +208,38 @@ class Repo:
         """Query remote repo about given ref.
         :return: ``('tag', sha)`` if ref is a tag in remote
                  ``('branch', sha)`` if ref is branch (aka "head") in remote
+                 ``('ref', sha)`` if ref is another full ref in remote, such
+                 as ``refs/pull/NNN/head``
                  ``(None, ref)`` if ref does not exist in remote. This happens
                  notably if ref if a commit sha (they can't be queried)
         """
-        out = self.log_call(['git', 'ls-remote', remote, ref],
-                            cwd=self.cwd if os.path.exists(self.cwd) else None,
-                            callwith=subprocess.check_output).strip()
-        for sha, fullref in (line.split() for line in out.splitlines()):
+        url = self._remote_url(remote)
+        # remotes are only configured once the repo is initialized
+        cloned = os.path.exists(self.cwd)
+        target = remote if cloned else url
+        if self.fetch_url(url) != url:
+            # answer like the mirror the remote is fetched from
+            url = target = self.fetch_url(url)
+        refs = None
+        if self.remote_refs is not None:
+            refs = self.remote_refs.get(url, ref)
+        if refs is None:
+            out = self.log_call(
+                ['git', 'ls-remote', target, ref],
+                cwd=self.cwd if cloned else None,
+                callwith=subprocess.check_output)
+            refs = parse_ls_remote(out)
+            if self.remote_refs is not None:
+                self.remote_refs.update(url, [ref], refs)
+        for sha, fullref in refs:
             if fullref == 'refs/heads/' + ref:
                 return 'branch', sha
             elif fullref == 'refs/tags/' + ref:
                 return 'tag', sha
             elif fullref == ref and ref == 'HEAD':
                 return 'HEAD', sha
+            elif fullref in (ref, 'refs/' + ref):
+                return 'ref', sha
         return None, ref
 
     def log_call(self, cmd, callwith=subprocess.check_call,
@@ -154,41 +248,197 @@ class Repo:
         :param meth: the calling method to use.
         """
         logger.log(log_level, "%s> call %r", self.cwd, cmd)
-        try:
-            ret = callwith(cmd, **kw)
-        except Exception:
-            logger.error("%s> error calling %r", self.cwd, cmd)
-            raise
+        metrics.inc(self.cwd, 'git_subprocesses')
+        name = cmd if isinstance(cmd, str) else " ".join(cmd[:2])
+        with tracer.span(name, 'git', cwd=self.cwd, cmd=cmd) as trace:
+            try:
+                if self.runner is not None:
+                    ret = self.runner.call(cmd, callwith, **kw)
+                else:
+                    ret = callwith(cmd, **kw)
+            except CancelledException:
+                raise
+            except Exception as e:
+                trace['status'] = getattr(e, 'returncode', None)
+                logger.error("%s> error calling %r", self.cwd, cmd)
+                raise
+            trace['status'] = ret if callwith == subprocess.call else 0
         if callwith == subprocess.check_output:
             ret = console_to_str(ret)
         return ret
 
+    def _phase(self, name):
+        """Trace a phase of the aggregation."""
+        return tracer.span(name, 'phase', cwd=self.cwd)
+
     def aggregate(self):
         """ Aggregate all merges into the target branch
         If the target_dir doesn't exist, create an empty git repo otherwise
         clean it, add all remotes , and merge all merges.
+
+        Nothing is done if the repository is up to date, that is if none
+        of the merges moved since the last aggregation, and the aggregated
+        branch was left untouched.
+
+        :return: ``False`` if the repository was up to date, else ``True``
         """
         logger.info('Start aggregation of %s', self.cwd)
+        start = time.time()
         target_dir = self.cwd
 
         is_new = not os.path.exists(target_dir) or os.listdir(target_dir) == []
         if is_new:
-            cloned = self.init_repository(target_dir)
+            with self._phase('clone'):
+                cloned = self.init_repository(target_dir)
+        else:
+            with self._phase('up_to_date'):
+                up_to_date = self._is_up_to_date()
+            if up_to_date:
+                logger.info('%s is up to date', self.cwd)
+                # HEAD did not move, as the repo is up to date
+                self._save_state(
+                    save_head=False, duration=time.time() - start)
+                return False
 
+        self._set_sparse_checkout()
         self._switch_to_branch(self.target['branch'])
-        for r in self.remotes:
-            self._set_remote(**r)
-        self.fetch()
-        merges = self.merges
-        if not is_new or cloned:
-            # reset to the first merge
-            origin = merges[0]
-            merges = merges[1:]
-            self._reset_to(origin["remote"], origin["ref"])
-        for merge in merges:
-            self._merge(merge)
-        self._execute_shell_command_after()
+        with self._phase('remotes'):
+            for r in self.remotes:
+                self._set_remote(r['name'], self.fetch_url(r['url']))
+            self._borrow_objects()
+        with self._phase('fetch'):
+            self.fetch()
+        prefix_cache = self._merge_all(reset=not is_new or cloned)
+        with self._phase('shell_command_after'):
+            self._execute_shell_command_after()
+        values = {}
+        if self._depth is not None:
+            values['depth'] = self._depth
+        self._save_state(
+            inputs=self._inputs(self._fetched_shas()),
+            prefix_cache=prefix_cache,
+            duration=time.time() - start,
+            **values
+        )
         logger.info('End aggregation of %s', self.cwd)
+        return True
+
+    def expected_duration(self):
+        """Duration of the last run on the repo, in seconds, whether it was
+        aggregated or found up to date, or ``None`` if unknown."""
+        return self._read_state().get('duration')
+
+    def _inputs(self, shas):
+        """Everything the aggregation result depends on, as stored in the
+        repo state, given the resolved ``shas`` of the merges."""
+        inputs = {
+            'merges': [
+                [self._remote_url(merge['remote']),
+                 console_to_str(merge['ref']), sha]
+                for merge, sha in zip(self.merges, shas)
+            ],
+            'target': self.target['branch'],
+            'shell_command_after': self.shell_command_after,
+        }
+        if self.sparse:
+            inputs['sparse'] = sorted(self.sparse)
+        return inputs
+
+    def _resolve_merges(self):
+        """Resolve the merges on their remotes, unless they are pinned.
+
+        :return: the list of the shas of the merges, ``None`` for the
+                 merges that could not be resolved.
+        """
+        shas = []
+        for merge in self.merges:
+            ref = merge['ref']
+            if self._pinned_sha(merge):
+                shas.append(self._pinned_sha(merge))
+                continue
+            rtype, sha = self.query_remote_ref(
+                self._remote_url(merge['remote']), ref)
+            shas.append(sha if rtype is not None else None)
+        return shas
+
+    def _fetched_shas(self):
+        """Shas of the merges, as they were fetched."""
+        revs = [
+            self._pinned_sha(merge)
+            or (self._is_branch_commit(merge) and merge['ref'] + '^{commit}')
+            or self._local_ref(merge['remote'], merge['ref'])
+            for merge in self.merges
+        ]
+        return self.log_call(
+            ['git', 'rev-parse'] + revs,
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        ).split()
+
+    def _is_up_to_date(self):
+        """Tell if the last aggregation result is still valid.
+
+        That's the case if the merges resolve to the same shas as in the
+        last aggregation, and the target branch is checked out, clean, and
+        still at the commit the last aggregation produced.
+        """
+        state = self._read_state()
+        if 'inputs' not in state:
+            return False
+        shas = self._resolve_merges()
+        if None in shas or self._inputs(shas) != state['inputs']:
+            return False
+        # a detached HEAD is resolved as HEAD, and is thus never up to date
+        head_ref = self.log_call(
+            ['git', 'rev-parse', '--symbolic-full-name', 'HEAD'],
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        ).strip()
+        if head_ref != 'refs/heads/' + self.target['branch']:
+            return False
+        if self._rev_parse('HEAD') != state.get('head'):
+            return False
+        status = self.log_call(
+            ['git', 'status', '--porcelain'],
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        )
+        return not status
+
+    def _state_path(self):
+        """Path of the file storing the state of the repository, in its git
+        directory, which ``.git`` may only point to. ``None`` if the
+        repository does not exist yet."""
+        if self._state_file is None:
+            if not os.path.exists(os.path.join(self.cwd, '.git')):
+                return None
+            self._state_file = os.path.join(self.cwd, self.log_call(
+                ['git', 'rev-parse', '--git-path', STATE_FILE],
+                callwith=subprocess.check_output, cwd=self.cwd).strip())
+        return self._state_file
+
+    def _read_state(self):
+        """Read what previous runs stored about the repository."""
+        path = self._state_path()
+        if path is None:
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, save_head=True, **values):
+        """Update the stored state of the repository with ``values``.
+
+        The current HEAD is stored along with them, if ``save_head``.
+        """
+        state = self._read_state()
+        state.update(values)
+        if save_head:
+            state['head'] = self._rev_parse('HEAD')
+        with open(self._state_path(), 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
 
     def init_repository(self, target_dir):
         """Inits the local repository
@@ -220,30 +470,177 @@ class Repo:
             target_dir,
         )
         cmd = ('git', 'clone')
-        if self.git_version >= (2, 17):
+        clone_filter = self.defaults.get('filter', DEFAULT_FILTER)
+        if clone_filter and self.git_version >= (2, 17):
             # Git added support for partial clone in 2.17
             # https://git-scm.com/docs/partial-clone
             # Speeds up cloning by functioning without a complete copy of
             # repository
-            cmd += ('--filter=blob:none',)
+            cmd += ('--filter=%s' % clone_filter,)
+        if self.sparse:
+            # only check out the files at the root, until the sparse
+            # checkout is set up
+            cmd += ('--sparse',)
         # Try to clone target branch, if it exists
-        rtype, _sha = self.query_remote_ref(repository, branch)
-        if rtype in {'branch', 'tag'}:
-            cmd += ('-b', branch)
+        if not self.frozen:
+            rtype, _sha = self.query_remote_ref(repository, branch)
+            if rtype in {'branch', 'tag'}:
+                cmd += ('-b', branch)
+        if self.object_store is not None:
+            for path in self.object_store.references(self):
+                cmd += ('--reference-if-able', path)
         # Emtpy fetch options to use global default for 1st clone
         cmd += self._fetch_options({})
-        cmd += (repository, target_dir)
+        cmd += (self.fetch_url(repository), target_dir)
         self.log_call(cmd)
         return True
 
-    def fetch(self):
+    def lock(self):
+        """Resolve the merges to the shas they currently point to.
+
+        :return: the list of merges, with their ``sha`` key set
+        """
+        locked = []
+        for merge, sha in zip(self.merges, self._resolve_merges()):
+            if sha is None:
+                raise GitAggregatorException(
+                    'Could not lock %s %s. No commit found for %s'
+                    % (merge['remote'], merge['ref'], merge['ref']))
+            locked.append(dict(merge, sha=sha))
+        return locked
+
+    def fetch(self, deepen=None):
+        """Fetch all merges, with one ``git fetch`` per remote.
+
+        Merges sharing the same remote and the same fetch options are
+        fetched together, passing all their refs to a single command.
+        Each ref is stored under :data:`LOCAL_REFS` so that later steps can
+        work from local objects only.
+
+        :param deepen: amount of commits to deepen the history of the
+                       merges with an adaptive depth by, rather than
+                       fetching all merges
+        """
         basecmd = ("git", "fetch")
         logger.info("Fetching required remotes")
-        for merge in self.merges:
-            cmd = basecmd + self._fetch_options(merge) + (merge["remote"],)
-            if merge["remote"] not in self.fetch_all:
-                cmd += (merge["ref"],)
+        for (remote, options), merges in self._fetch_groups().items():
+            if deepen:
+                merges = [m for m in merges if self._is_adaptive(m)]
+                if not merges:
+                    continue
+                options = ("--deepen=%d" % deepen,)
+            cmd = basecmd + options + (remote,)
+            pinned = []
+            if remote in self.fetch_all:
+                cmd += ("+refs/heads/*:refs/remotes/%s/*" % remote,)
+                # commits can't be fetched by sha from all remotes, that's
+                # what fetch_all is for: they'll come with the branches
+                pinned = [m for m in merges if self._pinned_sha(m)]
+                merges = [
+                    m for m in merges
+                    if not self._pinned_sha(m)
+                    and not self._is_branch_commit(m)
+                ]
+            cmd += tuple(
+                "+%s:%s" % (
+                    self._pinned_sha(m) or m["ref"],
+                    self._local_ref(remote, m["ref"]),
+                )
+                for m in merges
+            )
             self.log_call(cmd, cwd=self.cwd)
+            metrics.inc(self.cwd, 'fetches')
+            # unless no branch has them, such as pull requests pinned by
+            # the lock file
+            missing = self._missing_objects(
+                [self._pinned_sha(m) for m in pinned])
+            if missing:
+                self.log_call(basecmd + options + (remote,) + tuple(
+                    "+%s:%s" % (
+                        self._pinned_sha(m),
+                        self._local_ref(remote, m["ref"]),
+                    )
+                    for m in pinned if self._pinned_sha(m) in missing
+                ), cwd=self.cwd)
+                metrics.inc(self.cwd, 'fetches')
+        self._prune_local_refs()
+
+    def _missing_objects(self, shas):
+        """Return the commits or tags among ``shas`` which are not in the
+        repo, without fetching them from the promisor remote of partial
+        clones, as git does for missing objects."""
+        if not shas:
+            return []
+        out = self.log_call(
+            ['git', 'rev-list', '--no-walk', '--objects', '--filter=tree:0',
+             '--missing=print', '--ignore-missing'] + shas,
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        )
+        found = {line.split()[0] for line in out.splitlines()}
+        return [sha for sha in shas if console_to_str(sha) not in found]
+
+    def _fetch_groups(self):
+        """Group merges by remote and fetch options.
+
+        :return: ordered mapping of ``(remote, fetch_options)`` to the list
+                 of merges to fetch, without duplicate refs
+        """
+        groups = {}
+        for merge in self.merges:
+            key = (merge["remote"], self._fetch_options(merge))
+            merges = groups.setdefault(key, [])
+            if merge["ref"] not in (m["ref"] for m in merges):
+                merges.append(merge)
+        return groups
+
+    @staticmethod
+    def _local_ref(remote, ref):
+        """Name of the local ref where the given remote ref is fetched."""
+        return "%s%s/%s" % (LOCAL_REFS, remote, ref)
+
+    @staticmethod
+    def _pinned_sha(merge):
+        """Sha the merge is pinned to, by a lock file or by its ref."""
+        if is_sha(merge["ref"]):
+            return merge["ref"]
+        return merge.get("sha")
+
+    def _is_branch_commit(self, merge):
+        """True if the ref of ``merge`` is a commit, possibly abbreviated,
+        of a ``fetch_all`` remote, which comes with the branches."""
+        return merge["remote"] in self.fetch_all and ishex(merge["ref"])
+
+    def _merge_rev(self, merge):
+        """Local revision to use for the given merge, once fetched."""
+        if is_sha(merge["ref"]):
+            return merge["ref"]
+        if self._is_branch_commit(merge) and "sha" not in merge:
+            return merge["ref"] + "^{commit}"
+        if "sha" in merge:
+            return merge["sha"] + "^{commit}"
+        return self._local_ref(merge["remote"], merge["ref"]) + "^{commit}"
+
+    def _prune_local_refs(self):
+        """Drop fetched refs of merges which are not configured anymore."""
+        expected = {
+            self._local_ref(merge["remote"], merge["ref"])
+            for merge in self.merges
+        }
+        existing = self.log_call(
+            ["git", "for-each-ref", "--format=%(refname)", LOCAL_REFS],
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        ).splitlines()
+        stale = [ref for ref in existing if ref not in expected]
+        if stale:
+            logger.debug("Removing stale refs %s", stale)
+            self.log_call(
+                ["git", "update-ref", "--stdin"],
+                callwith=subprocess.check_output,
+                input="".join("delete %s\n" % ref for ref in stale).encode(),
+                cwd=self.cwd,
+            )
 
     def push(self):
         remote = self.target['remote']
@@ -253,7 +650,13 @@ class Repo:
                 "Cannot push %s, no target remote configured" % branch
             )
         logger.info("Push %s to %s", branch, remote)
-        self.log_call(['git', 'push', '-f', remote, branch], cwd=self.cwd)
+        url = self._remote_url(remote)
+        if self.fetch_url(url) != url:
+            # the remote is set to its mirror, push to the actual remote
+            remote = url
+        with self._phase('push'):
+            self.log_call(
+                ['git', 'push', '-f', remote, branch], cwd=self.cwd)
 
     def _check_status(self):
         """Check repo status and except if dirty."""
@@ -271,25 +674,123 @@ class Repo:
         cmd = tuple()
         for option in FETCH_DEFAULTS:
             value = merge.get(option, self.defaults.get(option))
+            if option == "depth" and value == ADAPTIVE_DEPTH:
+                value = self._adaptive_depth()
             if value:
                 cmd += ("--%s" % option, str(value))
         return cmd
 
-    def _reset_to(self, remote, ref):
-        if not self.force:
-            self._check_status()
+    def _is_adaptive(self, merge):
+        """True if the history of ``merge`` is deepened as needed."""
+        return merge.get(
+            "depth", self.defaults.get("depth")) == ADAPTIVE_DEPTH
+
+    def _adaptive_depth(self):
+        """Depth of the merges with an adaptive depth: the one the last
+        aggregation needed, or :data:`ADAPTIVE_DEPTH_START`."""
+        if self._depth is None:
+            self._depth = self._read_state().get(
+                'depth', ADAPTIVE_DEPTH_START)
+        return self._depth
+
+    def _deepen_to_merge_base(self, head, rev, merge):
+        """Deepen the history of the merges with an adaptive depth until
+        ``head`` and ``rev``, the one of ``merge``, have a merge base.
+
+        The history is deepened by the current depth at each step, doubling
+        it, until the merge base is fetched or the history is complete.
+
+        :raise GitAggregatorException: if there is no merge base in the
+                                       complete history, deepening the
+                                       history does not fetch any older
+                                       commit, or would go deeper than
+                                       :data:`ADAPTIVE_DEPTH_MAX`
+        """
+        if not any(self._is_adaptive(m) for m in self.merges):
+            return
+        shallow_path = None
+        while self.log_call(
+                ['git', 'merge-base', head, rev],
+                callwith=subprocess.call,
+                stdout=subprocess.DEVNULL,
+                cwd=self.cwd) != 0:
+            if shallow_path is None:
+                shallow_path = os.path.join(self.cwd, self.log_call(
+                    ['git', 'rev-parse', '--git-path', 'shallow'],
+                    callwith=subprocess.check_output,
+                    cwd=self.cwd,
+                ).strip())
+            shallow = self._read_shallow(shallow_path)
+            if shallow is None:
+                raise GitAggregatorException(
+                    'Could not find the merge base of %s %s: the histories '
+                    'are unrelated' % (merge['remote'], merge['ref']))
+            step = self._adaptive_depth()
+            if self._depth + step > ADAPTIVE_DEPTH_MAX:
+                raise GitAggregatorException(
+                    'Could not find the merge base of %s %s within %d '
+                    'commits' % (merge['remote'], merge['ref'], self._depth))
+            logger.info('Deepen history by %d commits to find the merge '
+                        'base of %s', step, rev)
+            with self._phase('fetch'):
+                self.fetch(deepen=step)
+            self._depth += step
+            if self._read_shallow(shallow_path) == shallow:
+                raise GitAggregatorException(
+                    'Could not find the merge base of %s %s: deepening the '
+                    'history fetched no older commit'
+                    % (merge['remote'], merge['ref']))
+
+    @staticmethod
+    def _read_shallow(path):
+        """Shallow boundary commits of the repo, listed in the ``shallow``
+        file at ``path``, or ``None`` if the history is complete."""
+        try:
+            with open(path) as f:
+                return f.read() or None
+        except FileNotFoundError:
+            return None
+
+    def _reset_to(self, merge):
+        remote, ref = merge["remote"], merge["ref"]
         logger.info('Reset branch to %s %s', remote, ref)
-        rtype, sha = self.query_remote_ref(remote, ref)
-        if rtype is None and not ishex(ref):
+        sha = self._rev_parse(self._merge_rev(merge))
+        if sha is None:
             raise GitAggregatorException(
                 'Could not reset %s to %s. No commit found for %s '
                 % (remote, ref, ref))
+        self._reset_hard(sha)
+
+    def _reset_hard(self, sha):
+        """Reset the current branch and the working tree to ``sha``."""
+        if not self.force:
+            self._check_status()
         cmd = ['git', 'reset', '--hard', sha]
         if logger.getEffectiveLevel() != logging.DEBUG:
             cmd.insert(2, '--quiet')
         self.log_call(cmd, cwd=self.cwd)
         self.log_call(['git', 'clean', '-ffd'], cwd=self.cwd)
 
+    def _rev_parse(self, rev):
+        """Resolve a local revision to a sha, or ``None`` if it is unknown."""
+        try:
+            return self.log_call(
+                ['git', 'rev-parse', '--verify', '--quiet', rev],
+                callwith=subprocess.check_output,
+                cwd=self.cwd,
+            ).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def _is_ancestor(self, rev, of="HEAD"):
+        """True if ``rev`` is already part of the history of ``of``."""
+        return self.log_call(
+            ['git', 'merge-base', '--is-ancestor', rev, of],
+            callwith=subprocess.call,
+            stderr=subprocess.DEVNULL,
+            cwd=self.cwd,
+        ) == 0
+
     def _switch_to_branch(self, branch_name):
         # check if the branch already exists
         logger.info("Switch to branch %s", branch_name)
@@ -301,8 +802,16 @@ class Repo:
             self.log_call(cmd, shell=True, cwd=self.cwd)
 
     def _merge(self, merge):
-        logger.info("Pull %s, %s", merge["remote"], merge["ref"])
-        cmd = ("git", "pull", "--ff", "--no-rebase")
+        """Merge a previously fetched merge into HEAD, without network,
+        unless the history must be deepened to find their merge base."""
+        remote, ref = merge["remote"], merge["ref"]
+        rev = self._merge_rev(merge)
+        self._deepen_to_merge_base('HEAD', rev, merge)
+        if self._is_ancestor(rev):
+            logger.info("Already merged %s, %s", remote, ref)
+            return
+        logger.info("Merge %s, %s", remote, ref)
+        cmd = ("git", "merge", "--ff")
         if self.git_version >= (1, 7, 10):
             # --edit and --no-edit appear with Git 1.7.10
             # see Documentation/RelNotes/1.7.10.txt of Git
@@ -310,9 +819,277 @@ class Repo:
             cmd += ('--no-edit',)
         if logger.getEffectiveLevel() != logging.DEBUG:
             cmd += ('--quiet',)
-        cmd += self._fetch_options(merge) + (merge["remote"], merge["ref"])
+        cmd += ("-m", self._merge_message(merge), rev)
         self.log_call(cmd, cwd=self.cwd)
 
+    def _can_merge_in_memory(self):
+        # git merge-tree --write-tree appeared in git 2.38
+        return self.git_version >= (2, 38)
+
+    def _merge_all(self, reset=True):
+        """Merge all the fetched merges into the target branch.
+
+        Intermediate results of the merge chain are cached in refs keyed by
+        the merges they contain: merging starts from the longest cached
+        prefix of the chain.
+
+        :param reset: ``False`` to merge the first merge too, rather than
+                      resetting to it
+        :return: the state of the cache, to be saved
+        """
+        keys = self._prefix_keys(self._fetched_shas())
+        cached = self._cached_prefixes()
+        start, head = 1, None
+        for i in reversed(range(1, len(keys))):
+            if keys[i] in cached:
+                start, head = i + 1, cached[keys[i]]
+                logger.info('Start from cached merge of %d merges', start)
+                break
+        heads = {}
+        if self._can_merge_in_memory():
+            if head is None:
+                head = self._rev_parse(self._merge_rev(self.merges[0]))
+            if head is None:
+                origin = self.merges[0]
+                raise GitAggregatorException(
+                    'Could not reset %s to %s. No commit found for %s '
+                    % (origin["remote"], origin["ref"], origin["ref"]))
+            with self._phase('merge'):
+                for i in range(start, len(self.merges)):
+                    head = heads[keys[i]] = self._merge_commit(
+                        head, self.merges[i])
+                    metrics.inc(self.cwd, 'merges')
+            with self._phase('reset'):
+                self._prefetch_blobs(head)
+                self._reset_hard(head)
+        else:
+            with self._phase('reset'):
+                if head is not None:
+                    self._prefetch_blobs(head)
+                    self._reset_hard(head)
+                elif reset:
+                    self._prefetch_blobs(self._merge_rev(self.merges[0]))
+                    self._reset_to(self.merges[0])
+                else:
+                    start = 0
+            with self._phase('merge'):
+                for i in range(start, len(self.merges)):
+                    self._merge(self.merges[i])
+                    if i:
+                        metrics.inc(self.cwd, 'merges')
+                        heads[keys[i]] = self._rev_parse('HEAD')
+        return self._update_prefix_cache(keys[1:], cached, heads)
+
+    def _prefetch_blobs(self, rev):
+        """Fetch the objects of the tree of ``rev`` that are missing from a
+        partial clone, in batches, before checking it out.
+
+        Otherwise, git fetches them lazily, in many small requests. This is
+        only done for repos with the ``prefetch-blobs`` default.
+        """
+        if not self.defaults.get('prefetch-blobs') or self.sparse:
+            # git fetches the files of sparse checkouts in batches itself
+            return
+        promisor = self._promisor_remote()
+        if promisor is None:
+            return
+        missing = None
+        # with a tree:0 filter, the blobs of missing trees are only listed
+        # once the trees are fetched, in a second batch
+        while True:
+            # --missing=print lists missing objects, rather than fetching them
+            out = self.log_call(
+                ['git', 'rev-list', '--objects', '--missing=print',
+                 '--no-walk', rev],
+                callwith=subprocess.check_output,
+                cwd=self.cwd,
+            )
+            previous, missing = missing, [
+                line[1:] for line in out.splitlines() if line.startswith('?')
+            ]
+            if not missing or missing == previous:
+                return
+            logger.info('Prefetching %d missing objects', len(missing))
+            # like git fetches missing objects itself, but in one request
+            self.log_call(
+                ['git', '-c', 'fetch.negotiationAlgorithm=noop', 'fetch',
+                 promisor, '--no-tags', '--no-write-fetch-head',
+                 '--recurse-submodules=no', '--filter=blob:none', '--stdin'],
+                callwith=subprocess.check_output,
+                input="".join(sha + "\n" for sha in missing).encode(),
+                cwd=self.cwd,
+            )
+
+    def _promisor_remote(self):
+        """Name of the remote missing objects of a partial clone are fetched
+        from, or ``None`` if the repo is not a partial clone."""
+        for key, value in self._git_config().items():
+            if (key.startswith('remote.') and key.endswith('.promisor')
+                    and value == 'true'):
+                return key[len('remote.'):-len('.promisor')]
+        return None
+
+    def _git_config(self):
+        """Config of the repo, with lowercase section and variable names.
+        """
+        out = self.log_call(
+            ['git', 'config', '--list'],
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        )
+        return dict(line.partition('=')[::2] for line in out.splitlines())
+
+    def _git_config_flag(self, key):
+        """Value of the boolean config ``key`` of the repo."""
+        return self.log_call(
+            ['git', 'config', '--type=bool', '--default=false', '--get', key],
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        ).strip() == 'true'
+
+    def _set_sparse_checkout(self):
+        """Restrict the working tree to the ``sparse`` directories, or
+        check out the whole tree again if there are none anymore."""
+        if not self.sparse:
+            # as sparse directories are part of the inputs, this tells if
+            # the last aggregation was sparse without running git
+            if 'sparse' in self._read_state().get('inputs', {}):
+                logger.info('Disable sparse checkout')
+                self.log_call(
+                    ['git', 'sparse-checkout', 'disable'], cwd=self.cwd)
+            return
+        if (self._git_config_flag('core.sparseCheckout') and
+                self._git_config_flag('core.sparseCheckoutCone')):
+            current = self.log_call(
+                ['git', 'sparse-checkout', 'list'],
+                callwith=subprocess.check_output,
+                cwd=self.cwd,
+            ).splitlines()
+            if sorted(current) == sorted(self.sparse):
+                return
+        logger.info('Sparse checkout of %s', ', '.join(self.sparse))
+        if self.git_version >= (2, 35):
+            cmd = ['git', 'sparse-checkout', 'set', '--cone']
+        else:
+            self.log_call(
+                ['git', 'sparse-checkout', 'init', '--cone'], cwd=self.cwd)
+            cmd = ['git', 'sparse-checkout', 'set']
+        self.log_call(cmd + ['--'] + self.sparse, cwd=self.cwd)
+
+    def _prefix_keys(self, shas):
+        """Cache keys of each prefix of the merge chain.
+
+        :param shas: the shas of the merges
+        """
+        keys = []
+        digest = hashlib.sha1()
+        for merge, sha in zip(self.merges, shas):
+            digest.update(("%s %s %s\n" % (
+                self._remote_url(merge['remote']),
+                console_to_str(merge['ref']),
+                sha,
+            )).encode())
+            keys.append(digest.hexdigest())
+        return keys
+
+    def _cached_prefixes(self):
+        """Mapping of the cache keys to the commits cached for them."""
+        out = self.log_call(
+            ['git', 'for-each-ref', '--format=%(refname) %(objectname)',
+             CACHE_REFS],
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        )
+        return {
+            ref[len(CACHE_REFS):]: sha
+            for ref, sha in (line.split() for line in out.splitlines())
+        }
+
+    def _update_prefix_cache(self, keys, cached, heads):
+        """Store new cached merges, and evict the least recently used ones.
+
+        :param keys: keys of the cached merges used by this aggregation
+        :param cached: the merges that were cached before it
+        :param heads: the merges it computed, by key
+        :return: the last time each cached merge was used, by key
+        """
+        last_used = self._read_state().get('prefix_cache', {})
+        now = time.time()
+        last_used.update((key, now) for key in keys)
+        kept = sorted(last_used, key=last_used.get, reverse=True)
+        kept = set(kept[:PREFIX_CACHE_SIZE])
+        commands = [
+            "update %s%s %s\n" % (CACHE_REFS, key, sha)
+            for key, sha in heads.items() if key in kept
+        ] + [
+            "delete %s%s\n" % (CACHE_REFS, key)
+            for key in cached if key not in kept
+        ]
+        if commands:
+            self.log_call(
+                ["git", "update-ref", "--stdin"],
+                callwith=subprocess.check_output,
+                input="".join(commands).encode(),
+                cwd=self.cwd,
+            )
+        return {key: last_used[key] for key in kept}
+
+    def _merge_commit(self, head, merge):
+        """Merge a previously fetched merge into the ``head`` commit.
+
+        :return: the sha of the resulting commit
+        """
+        remote, ref = merge["remote"], merge["ref"]
+        rev = self._rev_parse(self._merge_rev(merge))
+        if rev is None:
+            raise GitAggregatorException(
+                'Could not merge %s %s. No commit found for %s'
+                % (remote, ref, ref))
+        self._deepen_to_merge_base(head, rev, merge)
+        if self._is_ancestor(rev, head):
+            logger.info("Already merged %s, %s", remote, ref)
+            return head
+        if self._is_ancestor(head, rev):
+            logger.info("Fast-forward to %s, %s", remote, ref)
+            return rev
+        logger.info("Merge %s, %s", remote, ref)
+        try:
+            tree = self.log_call(
+                ['git', 'merge-tree', '--write-tree', '--name-only',
+                 head, rev],
+                callwith=subprocess.check_output,
+                cwd=self.cwd,
+            ).split()[0]
+        except subprocess.CalledProcessError as e:
+            if e.returncode != 1:
+                raise
+            raise GitAggregatorException(
+                'Merge conflict on %s %s:\n%s'
+                % (remote, ref, console_to_str(e.output)))
+        return self.log_call(
+            ['git', 'commit-tree', tree, '-p', head, '-p', rev,
+             '-m', self._merge_message(merge)],
+            callwith=subprocess.check_output,
+            cwd=self.cwd,
+        ).strip()
+
+    def _merge_message(self, merge):
+        return "Merge '%s' of %s" % (
+            merge["ref"], self._remote_url(merge["remote"]))
+
+    def _remote_url(self, remote):
+        """Url of the given remote name. Urls are returned unchanged."""
+        for r in self.remotes:
+            if r['name'] == remote:
+                return r['url']
+        return remote
+
+    def fetch_url(self, url):
+        """Url to clone and fetch the remote ``url`` from."""
+        if self.mirror and self.mirror_cache is not None:
+            return self.mirror_cache.url(url)
+        return url
+
     def _get_remotes(self):
         lines = self.log_call(
             ['git', 'remote', '-v'],
@@ -330,6 +1107,34 @@ class Repo:
                 )
         return remotes
 
+    def _borrow_objects(self):
+        """Add the stores of the remotes to the alternates of the repo.
+
+        Repos cloned with the object store already borrow its objects, this
+        makes the other repos borrow them too, as well as the objects of
+        remotes added since the clone.
+        """
+        if self.object_store is None:
+            return
+        paths = [
+            os.path.join(path, 'objects')
+            for path in self.object_store.references(self)
+        ]
+        if not paths:
+            return
+        alternates = os.path.join(self.cwd, self.log_call(
+            ['git', 'rev-parse', '--git-path', 'objects/info/alternates'],
+            callwith=subprocess.check_output, cwd=self.cwd).strip())
+        known = []
+        if os.path.exists(alternates):
+            with open(alternates) as f:
+                known = [os.path.normpath(line.strip()) for line in f]
+        missing = [path for path in paths if path not in known]
+        if missing:
+            logger.debug('Borrowing objects from %s', missing)
+            with open(alternates, 'a') as f:
+                f.writelines(path + '\n' for path in missing)
+
     def _set_remote(self, name, url):
         """Add remote to the repository. It's equivalent to the command
         git remote add <name> <url>
@@ -351,18 +1156,11 @@ class Repo:
             self.log_call(
                 ['git', 'remote', 'set-url', name, url], cwd=self.cwd)
 
-    def _github_api_get(self, path):
-        url = 'https://api.github.com' + path
-        token = os.environ.get('GITHUB_TOKEN')
-        headers = None
-        if token:
-            headers = {'Authorization': 'token %s' % token}
-        return requests.get(url, headers=headers)
-
-    def collect_prs_info(self, merges=None):
-        """Collect all pending merge PRs info.
+    def pull_requests(self, merges=None):
+        """List the merges that are GitHub pull requests.
 
-        :returns: mapping of PRs by state
+        :returns: list of PRs info, with ``remote``, ``ref``, ``owner``,
+                  ``repo``, ``pr``, ``path`` and ``shortcut`` keys
         """
         REPO_RE = re.compile(
             '^(https://github.com/|git@github.com:)'
@@ -370,7 +1168,7 @@ class Repo:
         PULL_RE = re.compile(
             '^(refs/)?pull/(?P<pr>[0-9]+)/head$')
         remotes = {r['name']: r['url'] for r in self.remotes}
-        all_prs = {}
+        pr_infos = []
         for merge in (merges or self.merges):
             remote = merge['remote']
             ref = merge['ref']
@@ -384,44 +1182,200 @@ class Repo:
                 logger.debug('%s is not a github pull reqeust', ref)
                 continue
             pr_info = {
+                'remote': remote,
+                'ref': ref,
                 'owner': repo_mo.group('owner'),
                 'repo': repo_mo.group('repo'),
                 'pr': pull_mo.group('pr'),
             }
             pr_info['path'] = '{owner}/{repo}/pulls/{pr}'.format(**pr_info)
             pr_info['shortcut'] = '{owner}/{repo}#{pr}'.format(**pr_info)
-            r = self._github_api_get('/repos/{path}'.format(**pr_info))
-            if r.status_code != 200:
-                logger.warning(
-                    'Could not get status of {path}. '
-                    'Reason: {r.status_code} {r.reason}'.format(r=r, **pr_info)
-                )
-                continue
-            rj = r.json()
-            pr_info['raw'] = rj
+            pr_infos.append(pr_info)
+        return pr_infos
+
+    def _merged_pull_refs(self):
+        """Return the local refs of the merges included in the first merge.
+
+        They are listed from the objects fetched by the last aggregation,
+        with a single ``git for-each-ref --merged``.
+        """
+        if self._merged_refs is None:
+            self._merged_refs = set()
+            base = self._merge_rev(self.merges[0])
+            if os.path.isdir(self.cwd) and self._rev_parse(base):
+                self._merged_refs.update(self.log_call(
+                    ['git', 'for-each-ref', '--merged', base,
+                     '--format=%(refname)', LOCAL_REFS],
+                    callwith=subprocess.check_output,
+                    cwd=self.cwd,
+                ).split())
+        return self._merged_refs
+
+    def is_merged_offline(self, pr_info):
+        """Tell if a PR is merged, without querying GitHub.
+
+        A PR whose head commit is an ancestor of the first merge, the
+        upstream branch, is merged. Other PRs are undecided.
+        """
+        first = self.merges[0]
+        if (pr_info['remote'], pr_info['ref']) == (
+                first['remote'], first['ref']):
+            return False
+        local_ref = self._local_ref(pr_info['remote'], pr_info['ref'])
+        return local_ref in self._merged_pull_refs()
+
+    def moved_pull_requests(self):
+        """List the PRs whose head moved since they were fetched.
+
+        The head of each PR on its remote, as answered by
+        :meth:`query_remote_ref`, is compared to the sha it is pinned to in
+        the lock file, or to the one fetched by the last aggregation.
+
+        :returns: list of PRs info, as :meth:`pull_requests` returns them,
+                  with the ``old`` and ``new`` shas of their head, ``old``
+                  being ``None`` if it was never fetched
+        """
+        pinned = {
+            (merge['remote'], merge['ref']): self._pinned_sha(merge)
+            for merge in self.merges
+        }
+        fetched = {}
+        if os.path.isdir(self.cwd):
+            for line in self.log_call(
+                    ['git', 'for-each-ref', '--format=%(objectname) '
+                     '%(refname)', LOCAL_REFS],
+                    callwith=subprocess.check_output,
+                    cwd=self.cwd).splitlines():
+                sha, refname = line.split()
+                fetched[refname] = sha
+        moved = []
+        for pr_info in self.pull_requests():
+            remote, ref = pr_info['remote'], pr_info['ref']
+            old = pinned[(remote, ref)] or fetched.get(
+                self._local_ref(remote, ref))
+            ref_type, new = self.query_remote_ref(remote, ref)
+            if ref_type is None:
+                new = None
+            if old != new:
+                pr_info['old'], pr_info['new'] = old, new
+                moved.append(pr_info)
+        return moved
+
+    def show_moved_prs(self):
+        """Log the PRs whose head moved since they were fetched.
+
+        :returns: the moved PRs
+        """
+        moved = self.moved_pull_requests()
+        for pr_info in moved:
+            if pr_info['new'] is None:
+                logger.warning('{shortcut} not found'.format(**pr_info))
+            elif pr_info['old'] is None:
+                logger.info(
+                    '{shortcut} not fetched yet, at {new}'.format(**pr_info))
+            else:
+                logger.info(
+                    '{shortcut} moved from {old} to {new}'.format(**pr_info))
+        return moved
+
+    def iter_prs_info(self, merges=None, offline=False):
+        """Resolve all pending merge PRs info.
+
+        PRs already resolved by :meth:`GithubClient.prefetch_pulls
+        <git_aggregator.github.GithubClient.prefetch_pulls>` are not queried
+        again. Only the fields used in reports are kept from the responses
+        of GitHub, and each PR is yielded as soon as it is resolved.
+
+        :param offline: ``True`` to only query GitHub for the PRs that are
+                        not merged according to :meth:`is_merged_offline`
+        :returns: iterator of PRs info, as :meth:`pull_requests` returns
+                  them, with their ``state``, ``url``, ``merged`` status and
+                  ``labels`` as text, and their ``label_names``
+        """
+        pr_infos = self.pull_requests(merges)
+        prefetched = []
+        for pr_info in pr_infos:
+            if offline and self.is_merged_offline(pr_info):
+                logger.debug('%s is merged', pr_info['shortcut'])
+                prefetched.append({
+                    'state': 'closed',
+                    'merged': True,
+                    'html_url': 'https://github.com/{owner}/{repo}/pull/{pr}'
+                    .format(**pr_info),
+                    'labels': [],
+                })
+            else:
+                prefetched.append(self.github.pull(
+                    pr_info['owner'], pr_info['repo'], pr_info['pr']))
+        responses = self.github.iter_many(
+            '/repos/{path}'.format(**pr_info)
+            for pr_info, rj in zip(pr_infos, prefetched)
+            if rj is None
+        )
+        for pr_info, rj in zip(pr_infos, prefetched):
+            if rj is None:
+                r = next(responses)
+                if r.status_code != 200:
+                    logger.warning(
+                        'Could not get status of {path}. '
+                        'Reason: {r.status_code} {r.reason}'.format(
+                            r=r, **pr_info)
+                    )
+                    continue
+                rj = r.json()
             pr_info['state'] = rj.get('state')
             pr_info['url'] = rj.get('html_url')
-            pr_info['labels'] = ", ".join(
+            pr_info['label_names'] = [
                 label['name'] for label in rj.get('labels')
-            )
+            ]
+            pr_info['labels'] = ", ".join(pr_info['label_names'])
             pr_info['merged'] = (
                 not rj.get('merged') and 'not ' or ''
             ) + 'merged'
+            yield pr_info
+        # let the client clean up once all responses are received
+        next(responses, None)
+
+    def collect_prs_info(self, merges=None, offline=False):
+        """Collect all pending merge PRs info.
+
+        :param offline: see :meth:`iter_prs_info`
+        :returns: mapping of PRs by state
+        """
+        all_prs = {}
+        for pr_info in self.iter_prs_info(merges, offline):
             all_prs.setdefault(pr_info['state'], []).append(pr_info)
         return all_prs
 
-    def show_closed_prs(self):
-        """Log only closed PRs."""
-        all_prs = self.collect_prs_info()
+    def show_closed_prs(self, offline=False, report=None):
+        """Log only closed PRs.
+
+        :param report: optional :class:`~git_aggregator.report.JsonlReport`
+                       to write the PRs to, as they are resolved, rather
+                       than logging them
+        """
+        if report is not None:
+            for pr_info in self.iter_prs_info(offline=offline):
+                if pr_info['state'] == 'closed':
+                    report.add(self.cwd, pr_info)
+            return
+        all_prs = self.collect_prs_info(offline=offline)
         for pr_info in all_prs.get('closed', []):
             logger.info(
                 '{url} in state {state} ({merged}; labels: {labels})'
                 .format(**pr_info)
             )
 
-    def show_all_prs(self):
-        """Log all PRs grouped by state."""
-        for __, prs in self.collect_prs_info().items():
+    def show_all_prs(self, offline=False, report=None):
+        """Log all PRs grouped by state.
+
+        :param report: see :meth:`show_closed_prs`
+        """
+        if report is not None:
+            for pr_info in self.iter_prs_info(offline=offline):
+                report.add(self.cwd, pr_info)
+            return
+        for __, prs in self.collect_prs_info(offline=offline).items():
             for pr_info in prs:
                 logger.info(
                     '{url} in state {state} ({merged})'.format(**pr_info)
@@ -0,0 +1,58 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import json
+import sys
+import threading
+
+
+class JsonlReport:
+    """Report pull requests as JSON Lines, one record per pull request.
+
+    Records are written as soon as they are added, from any thread, and
+    only counters are kept, so that the memory used does not depend on the
+    amount of pull requests. :meth:`summary` ends the report with a record
+    summarizing all repos.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+        self._repos = set()
+        self._states = {}
+        self._merged = 0
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        self.stream.write(line + '\n')
+        self.stream.flush()
+
+    def add(self, repo, pr_info):
+        """Write the record of a pull request of ``repo``.
+
+        :param pr_info: PR info, as
+                        :meth:`~git_aggregator.repo.Repo.iter_prs_info`
+                        yields it
+        """
+        merged = pr_info['merged'] == 'merged'
+        with self._lock:
+            self._repos.add(repo)
+            self._states[pr_info['state']] = (
+                self._states.get(pr_info['state'], 0) + 1)
+            self._merged += merged
+            self._write({
+                'repo': repo,
+                'url': pr_info['url'],
+                'state': pr_info['state'],
+                'merged': merged,
+                'labels': pr_info['label_names'],
+            })
+
+    def summary(self):
+        """Write the summary of the pull requests of all repos."""
+        with self._lock:
+            self._write({'summary': {
+                'repos': len(self._repos),
+                'pull_requests': sum(self._states.values()),
+                'states': dict(sorted(self._states.items())),
+                'merged': self._merged,
+            }})
@@ -0,0 +1,95 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import asyncio
+import logging
+import subprocess
+import threading
+
+from .exception import CancelledException
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncGitRunner:
+    """Run subprocesses on an asyncio event loop, with a bounded
+    concurrency.
+
+    The event loop runs in its own thread, so that :meth:`call` can be
+    used as a drop-in replacement of the :mod:`subprocess` functions by
+    any number of threads, while at most ``max_processes`` subprocesses
+    run at the same time. :meth:`cancel` kills the running subprocesses,
+    and makes all pending and later calls fail.
+    """
+
+    def __init__(self, max_processes):
+        self.max_processes = max(max_processes, 1)
+        self.cancelled = False
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name='git-runner', daemon=True)
+        self._processes = set()
+        self._semaphore = None
+
+    def __enter__(self):
+        self._thread.start()
+        self._submit(self._setup()).result()
+        return self
+
+    def __exit__(self, *exc_args):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _setup(self):
+        self._semaphore = asyncio.Semaphore(self.max_processes)
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def call(self, cmd, callwith=subprocess.check_call, **kw):
+        """Run ``cmd`` like ``callwith(cmd, **kw)`` would.
+
+        :param callwith: one of :func:`subprocess.call`,
+                         :func:`subprocess.check_call` or
+                         :func:`subprocess.check_output`
+        :raise CancelledException: if the runner was cancelled
+        """
+        return self._submit(self._run(cmd, callwith, **kw)).result()
+
+    def cancel(self):
+        """Kill all running subprocesses, and refuse to start new ones."""
+        self.cancelled = True
+        self._loop.call_soon_threadsafe(self._kill_all)
+
+    def _kill_all(self):
+        for process in self._processes:
+            if process.returncode is None:
+                process.terminate()
+
+    async def _run(self, cmd, callwith, shell=False, input=None, **kw):
+        if callwith is subprocess.check_output:
+            kw['stdout'] = subprocess.PIPE
+        if input is not None:
+            kw['stdin'] = subprocess.PIPE
+        async with self._semaphore:
+            if self.cancelled:
+                raise CancelledException(cmd)
+            if shell:
+                process = await asyncio.create_subprocess_shell(cmd, **kw)
+            else:
+                process = await asyncio.create_subprocess_exec(*cmd, **kw)
+            self._processes.add(process)
+            try:
+                output, _ = await process.communicate(input)
+            finally:
+                self._processes.discard(process)
+        if self.cancelled:
+            raise CancelledException(cmd)
+        if callwith is subprocess.call:
+            return process.returncode
+        if process.returncode:
+            raise subprocess.CalledProcessError(
+                process.returncode, cmd, output=output)
+        if callwith is subprocess.check_output:
+            return output
+        return 0
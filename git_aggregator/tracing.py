@@ -0,0 +1,77 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    """Record timed spans in the Chrome trace event format.
+
+    The resulting file can be opened in Perfetto or ``chrome://tracing``.
+    Nothing is recorded until the tracer is enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+
+    def enable(self):
+        self.enabled = True
+
+    @contextmanager
+    def span(self, name, cat, **args):
+        """Record the duration of the enclosed block.
+
+        :param name: name of the span.
+        :param cat: category of the span, such as ``git`` or ``phase``.
+        :param args: details attached to the span. The dict is yielded,
+                     so that the block can add more of them.
+        """
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            thread = threading.current_thread()
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': thread.ident,
+                'args': args,
+            }
+            with self._lock:
+                self._events.append(event)
+                self._threads[thread.ident] = thread.name
+
+    def write(self, path):
+        """Write the recorded events to ``path``, as JSON."""
+        with self._lock:
+            events = [
+                {
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': os.getpid(),
+                    'tid': tid,
+                    'args': {'name': name},
+                }
+                for tid, name in self._threads.items()
+            ] + self._events
+        with open(path, 'w') as f:
+            json.dump(
+                {'traceEvents': events, 'displayTimeUnit': 'ms'},
+                f, default=str)
+
+
+tracer = Tracer()
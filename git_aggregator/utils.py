@@ -1,9 +1,16 @@
 # © 2015 ACSONE SA/NV
 # © ANYBOX https://github.com/anybox/anybox.recipe.odoo
 # License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import hashlib
 import logging
 import os
+import subprocess
 import threading
+from urllib.parse import urljoin
+from urllib.request import pathname2url
+
+from .metrics import metrics
+from .tracing import tracer
 
 logger = logging.getLogger(__name__)
 
@@ -40,3 +47,49 @@ class ThreadNameKeeper:
 
     def __exit__(self, *exc_args):
         threading.current_thread().name = self._name
+
+
+def url_path(directory, url):
+    """Path of the bare repository dedicated to ``url`` in ``directory``.
+    >>> url_path('/cache', 'https://github.com/OCA/web.git')
+    '/cache/b65d90ae6d035a4c.git'
+    """
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(directory, key + '.git')
+
+
+def path_to_url(url):
+    """``file://`` url of ``url``, if it is a local path.
+
+    Git clones local paths by copying or hard linking the whole repository,
+    ignoring ``--filter`` and ``--depth``, which it only honours through
+    its transport, used for ``file://`` urls.
+    >>> path_to_url('/nonexistent/repo.git')
+    '/nonexistent/repo.git'
+    >>> path_to_url('https://github.com/OCA/web.git')
+    'https://github.com/OCA/web.git'
+    """
+    if '://' in url or not os.path.exists(url):
+        return url
+    return urljoin('file:', pathname2url(os.path.abspath(url)))
+
+
+def git_call(cmd, callwith=subprocess.call, **kw):
+    """Run ``cmd``, a git command run for all repos rather than one.
+
+    Like :meth:`~git_aggregator.repo.Repo.log_call`, the command is traced
+    and counted, in the metrics of the whole run.
+
+    :return: the result of ``callwith``
+    """
+    logger.debug("call %r", cmd)
+    metrics.inc(None, 'git_subprocesses')
+    name = 'git ' + cmd[3 if cmd[1] == '--git-dir' else 1]
+    with tracer.span(name, 'git', cmd=cmd) as trace:
+        try:
+            ret = callwith(cmd, **kw)
+        except subprocess.CalledProcessError as e:
+            trace['status'] = e.returncode
+            raise
+        trace['status'] = ret if callwith == subprocess.call else 0
+    return ret
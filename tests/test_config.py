@@ -1,6 +1,7 @@
 # © 2015 ACSONE SA/NV
 # License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
 import os
+import shutil
 import tempfile
 import unittest
 from textwrap import dedent
@@ -393,6 +394,45 @@ class TestConfig(unittest.TestCase):
             remotes[0]['url'], os.environ['TEST_REPO']
         )
 
+    def test_lock(self):
+        config_yaml = """
+/product_attribute:
+    remotes:
+        oca: https://github.com/OCA/product-attribute.git
+    merges:
+        - oca 8.0
+        - oca refs/pull/105/head
+"""
+        repos = config.get_repos(self._parse_config(config_yaml))
+        lock_dir = tempfile.mkdtemp()
+        lock_path = os.path.join(lock_dir, 'repos.lock.yaml')
+        try:
+            with self.assertRaises(ConfigException) as ex:
+                config.apply_lock(repos, lock_path)
+            self.assertEqual(
+                ex.exception.args[0],
+                'Unable to find lock file: %s' % lock_path)
+            config.write_lock(lock_path, {
+                '/product_attribute': [
+                    {'remote': 'oca', 'ref': '8.0', 'sha': 'a' * 40},
+                    {'remote': 'oca', 'ref': 'refs/pull/105/head',
+                     'sha': 'b' * 40},
+                ],
+            })
+            config.apply_lock(repos, lock_path)
+            self.assertTrue(repos[0]['frozen'])
+            self.assertEqual(
+                [m['sha'] for m in repos[0]['merges']], ['a' * 40, 'b' * 40])
+            repos[0]['merges'].pop()
+            with self.assertRaises(ConfigException) as ex:
+                config.apply_lock(repos, lock_path)
+            self.assertEqual(
+                ex.exception.args[0],
+                '/product_attribute: Merges differ from lock file %s, '
+                'it must be updated.' % lock_path)
+        finally:
+            shutil.rmtree(lock_dir)
+
     def test_fetch_all_string(self):
         config_yaml = """
             ./test:
@@ -435,3 +475,47 @@ class TestConfig(unittest.TestCase):
         config_yaml = dedent(config_yaml)
         repos = config.get_repos(self._parse_config(config_yaml))
         self.assertIs(repos[0]["fetch_all"], True)
+
+    def test_mirror(self):
+        config_yaml = """
+            ./test:
+                remotes:
+                    oca: https://github.com/test/test.git
+                merges:
+                    - oca 8.0
+                target: oca aggregated_branch_name
+                mirror: no
+            """
+        config_yaml = dedent(config_yaml)
+        repos = config.get_repos(self._parse_config(config_yaml))
+        self.assertIs(repos[0]["mirror"], False)
+
+    def test_filter_exception(self):
+        config_yaml = """
+/web:
+    remotes:
+        oca: https://github.com/OCA/web.git
+    merges:
+        - oca 8.0
+    defaults:
+        filter: blob:big
+"""
+        with self.assertRaises(ConfigException) as ex:
+            config.get_repos(self._parse_config(config_yaml))
+        self.assertEqual(
+            ex.exception.args[0],
+            '/web: Filter must be blob:none, blob:limit=<n>, tree:0 or '
+            'false, not blob:big.')
+
+    def test_sparse(self):
+        config_yaml = """
+            ./test:
+                remotes:
+                    oca: https://github.com/test/test.git
+                merges:
+                    - oca 8.0
+                sparse: addon_a
+            """
+        config_yaml = dedent(config_yaml)
+        repos = config.get_repos(self._parse_config(config_yaml))
+        self.assertEqual(repos[0]["sparse"], ["addon_a"])
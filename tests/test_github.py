@@ -0,0 +1,354 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import io
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import mkdtemp
+
+from git_aggregator.github import GithubClient, ResponseCache
+from git_aggregator.repo import Repo
+from git_aggregator.report import JsonlReport
+
+PULL_PATH_RE = re.compile(
+    '^/repos/(?P<owner>.*?)/(?P<repo>.*?)/pulls/(?P<pr>[0-9]+)$')
+GRAPHQL_REPO_RE = re.compile(
+    r'(?P<alias>\w+): repository\(owner: "(?P<owner>.*?)", '
+    r'name: "(?P<repo>.*?)"\)')
+GRAPHQL_PULL_RE = re.compile(
+    r'(?P<alias>\w+): pullRequest\(number: (?P<pr>[0-9]+)\)')
+MISSING_PR = 404
+
+
+class GithubStub(ThreadingHTTPServer):
+    """Local stand-in for api.github.com, serving pull requests.
+
+    Pull requests with an even number are closed, others are open, and
+    number :data:`MISSING_PR` does not exist, in both APIs. They
+    are served with an ``ETag``, to answer conditional requests with
+    ``304 Not Modified``. The server records the requests, the connections
+    and the amount of requests handled at the same time.
+
+    With a ``rate_limit``, each token can send that amount of requests per
+    ``rate_window`` seconds, further requests being answered with a 403.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay=0.05):
+        super().__init__(('127.0.0.1', 0), GithubStubHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.paths = []
+        self.not_modified = []
+        self.graphql_queries = []
+        self.rate_limit = None
+        self.rate_window = 1
+        self.quotas = {}
+        self.tokens = []
+        self.limited = 0
+        self.connections = 0
+        self.running = 0
+        self.max_running = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+class GithubStubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def rate_limited(self):
+        """Apply the rate limit, answering a 403 if it is exceeded."""
+        server = self.server
+        token = self.headers.get('Authorization')
+        with server.lock:
+            server.tokens.append(token)
+            if server.rate_limit is None:
+                return False
+            now = time.time()
+            quota = server.quotas.get(token)
+            if quota is None or quota['reset'] <= now:
+                quota = server.quotas[token] = {
+                    'remaining': server.rate_limit,
+                    'reset': now + server.rate_window,
+                }
+            limited = not quota['remaining']
+            if limited:
+                server.limited += 1
+            else:
+                quota['remaining'] -= 1
+        self.rate_limit_headers = {
+            'X-RateLimit-Remaining': str(quota['remaining']),
+            'X-RateLimit-Reset': str(int(quota['reset']) + 1),
+        }
+        if limited:
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        return limited
+
+    def end_headers(self):
+        for name, value in getattr(self, 'rate_limit_headers', {}).items():
+            self.send_header(name, value)
+        super().end_headers()
+
+    def do_GET(self):
+        if self.rate_limited():
+            return
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        time.sleep(server.delay)
+        with server.lock:
+            server.running -= 1
+        mo = PULL_PATH_RE.match(self.path)
+        if not mo or int(mo.group('pr')) == MISSING_PR:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        pr = int(mo.group('pr'))
+        etag = '"pr-%d"' % pr
+        if self.headers.get('If-None-Match') == etag:
+            with server.lock:
+                server.not_modified.append(self.path)
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = json.dumps({
+            'state': 'open' if pr % 2 else 'closed',
+            'html_url': 'https://github.com/{owner}/{repo}/pull/{pr}'.format(
+                **mo.groupdict()),
+            'labels': [{'name': 'label%d' % pr}],
+            'merged': False,
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.rate_limited():
+            return
+        query = json.loads(
+            self.rfile.read(int(self.headers['Content-Length'])))['query']
+        with self.server.lock:
+            self.server.graphql_queries.append(query)
+        data = {}
+        for line in query.splitlines():
+            mo = GRAPHQL_REPO_RE.search(line)
+            if mo:
+                repo_mo = mo
+                repo = data[repo_mo.group('alias')] = {}
+                continue
+            pull_mo = GRAPHQL_PULL_RE.search(line)
+            if not pull_mo:
+                continue
+            pr = int(pull_mo.group('pr'))
+            repo[pull_mo.group('alias')] = None if pr == MISSING_PR else {
+                'state': 'OPEN' if pr % 2 else 'CLOSED',
+                'url': 'https://github.com/{owner}/{repo}/pull/{pr}'.format(
+                    pr=pr, **repo_mo.groupdict()),
+                'labels': {'nodes': [{'name': 'label%d' % pr}]},
+            }
+        body = json.dumps({'data': data}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGithub(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = GithubStub()
+        thread = threading.Thread(target=self.stub.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+
+    def make_repo(self, prs, concurrency, cache=None, tokens=None):
+        return Repo(
+            '/nonexistent',
+            [{'name': 'oca', 'url': 'https://github.com/OCA/web.git'},
+             {'name': 'local', 'url': 'file:///tmp/web'}],
+            [{'remote': 'oca', 'ref': '16.0'},
+             {'remote': 'local', 'ref': 'refs/pull/1/head'}] + [
+                {'remote': 'oca', 'ref': 'refs/pull/%d/head' % pr}
+                for pr in prs
+            ],
+            {'remote': 'oca', 'branch': 'agg'},
+            github=GithubClient(
+                base_url=self.stub.url, concurrency=concurrency,
+                cache=cache, tokens=tokens),
+        )
+
+    def test_collect_prs_info(self):
+        repo = self.make_repo(range(1, 21), concurrency=4)
+        all_prs = repo.collect_prs_info()
+        self.assertEqual(sorted(all_prs), ['closed', 'open'])
+        self.assertEqual(
+            [pr_info['pr'] for pr_info in all_prs['closed']],
+            [str(pr) for pr in range(2, 21, 2)],
+        )
+        self.assertEqual(
+            [pr_info['pr'] for pr_info in all_prs['open']],
+            [str(pr) for pr in range(1, 21, 2)],
+        )
+        self.assertEqual(all_prs['open'][0]['labels'], 'label1')
+        self.assertEqual(all_prs['open'][0]['merged'], 'not merged')
+        # only github merges are queried, concurrently, on kept alive
+        # connections
+        self.assertEqual(len(self.stub.paths), 20)
+        self.assertGreater(self.stub.max_running, 1)
+        self.assertLessEqual(self.stub.max_running, 4)
+        self.assertLessEqual(self.stub.connections, 4)
+
+    def test_collect_prs_info_error(self):
+        repo = self.make_repo([1, 2], concurrency=2)
+        repo.github.base_url += '/missing'
+        with self.assertLogs('git_aggregator.repo', 'WARNING'):
+            self.assertEqual(repo.collect_prs_info(), {})
+
+    def test_jsonl_report(self):
+        stream = io.StringIO()
+        report = JsonlReport(stream)
+        self.make_repo([1, 2, MISSING_PR], 2).show_closed_prs(report=report)
+        with self.assertLogs('git_aggregator.repo', 'WARNING'):
+            self.make_repo([3, MISSING_PR], 2).show_all_prs(report=report)
+        report.summary()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(records, [{
+            'repo': '/nonexistent',
+            'url': 'https://github.com/OCA/web/pull/2',
+            'state': 'closed',
+            'merged': False,
+            'labels': ['label2'],
+        }, {
+            'repo': '/nonexistent',
+            'url': 'https://github.com/OCA/web/pull/3',
+            'state': 'open',
+            'merged': False,
+            'labels': ['label3'],
+        }, {
+            'summary': {
+                'repos': 1,
+                'pull_requests': 2,
+                'states': {'closed': 1, 'open': 1},
+                'merged': 0,
+            },
+        }])
+
+    def test_cache(self):
+        cache_dir = mkdtemp('test_github')
+        self.addCleanup(shutil.rmtree, cache_dir)
+        repo = self.make_repo(range(1, 5), 2, ResponseCache(cache_dir))
+        all_prs = repo.collect_prs_info()
+        self.assertEqual(len(self.stub.paths), 4)
+        self.assertEqual(len(os.listdir(cache_dir)), 4)
+        # fresh responses are not requested again
+        self.assertEqual(repo.collect_prs_info(), all_prs)
+        self.assertEqual(len(self.stub.paths), 4)
+        # expired responses are revalidated, except the ones of closed prs
+        repo = self.make_repo(
+            range(1, 5), 2, ResponseCache(cache_dir, ttl=0))
+        self.assertEqual(repo.collect_prs_info(), all_prs)
+        self.assertEqual(
+            sorted(self.stub.paths[4:]), sorted(self.stub.not_modified))
+        self.assertEqual(sorted(self.stub.not_modified), [
+            '/repos/OCA/web/pulls/1', '/repos/OCA/web/pulls/3'])
+
+    def test_cache_eviction(self):
+        cache_dir = mkdtemp('test_github')
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = ResponseCache(cache_dir)
+        self.make_repo(range(1, 5), 2, cache).collect_prs_info()
+        size = sum(
+            os.path.getsize(os.path.join(cache_dir, name))
+            for name in os.listdir(cache_dir))
+        cache.max_size = size - 1
+        cache.prune()
+        self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    def test_graphql(self):
+        self.stub.delay = 0
+        github = GithubClient(base_url=self.stub.url, concurrency=2)
+        prs = list(range(1, 151)) + [MISSING_PR]
+        repos = [self.make_repo(prs, 2), self.make_repo(prs[::2], 2)]
+        expected = [
+            repo.collect_prs_info() for repo in repos
+        ]
+        rest_requests = len(self.stub.paths)
+        for repo in repos:
+            repo.github = github
+        github.prefetch_pulls(
+            (pr_info['owner'], pr_info['repo'], pr_info['pr'])
+            for repo in repos
+            for pr_info in repo.pull_requests()
+        )
+        # 151 distinct PRs, referenced in 2 repos
+        self.assertEqual(len(self.stub.graphql_queries), 2)
+        for repo, repo_expected in zip(repos, expected):
+            with self.assertLogs('git_aggregator.repo', 'WARNING'):
+                all_prs = repo.collect_prs_info()
+            self.assertEqual(all_prs, repo_expected)
+        # only the missing PR was queried with REST, once per repo
+        self.assertEqual(
+            self.stub.paths[rest_requests:],
+            ['/repos/OCA/web/pulls/%d' % MISSING_PR] * 2)
+
+    def test_graphql_url(self):
+        self.assertEqual(
+            GithubClient(base_url='https://api.github.com').graphql_url,
+            'https://api.github.com/graphql')
+        self.assertEqual(
+            GithubClient(base_url='https://ghe.example/api/v3').graphql_url,
+            'https://ghe.example/api/graphql')
+
+    def test_rate_limit_tokens(self):
+        self.stub.rate_limit = 4
+        self.stub.rate_window = 60
+        repo = self.make_repo(range(1, 9), 2, tokens=['t1', 't2'])
+        all_prs = repo.collect_prs_info()
+        self.assertEqual(
+            sum(len(pr_infos) for pr_infos in all_prs.values()), 8)
+        # the quotas of both tokens were used, without exceeding them
+        self.assertEqual(
+            sorted(set(self.stub.tokens)), ['token t1', 'token t2'])
+        self.assertEqual(self.stub.limited, 0)
+
+    def test_rate_limit_wait(self):
+        self.stub.rate_limit = 2
+        self.stub.delay = 0
+        repo = self.make_repo(range(1, 5), 3, tokens=['t1'])
+        with self.assertLogs('git_aggregator.github', 'WARNING'):
+            all_prs = repo.collect_prs_info()
+        # the quota is unknown until the first response: a request went
+        # over it, and was retried after the reset of the window, like the
+        # others, rather than failing
+        self.assertGreaterEqual(self.stub.limited, 1)
+        self.assertEqual(
+            sum(len(pr_infos) for pr_infos in all_prs.values()), 4)
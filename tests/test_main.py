@@ -0,0 +1,37 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import unittest
+from types import SimpleNamespace
+
+from git_aggregator import main
+
+
+def fake_repo(cwd, merges, duration):
+    return SimpleNamespace(
+        cwd=cwd,
+        merges=[{'remote': 'oca', 'ref': str(i)} for i in range(merges)],
+        expected_duration=lambda: duration,
+    )
+
+
+class TestMain(unittest.TestCase):
+
+    def test_longest_first(self):
+        repos = [
+            fake_repo('/small', 2, 5.0),
+            fake_repo('/unknown_small', 1, None),
+            fake_repo('/big', 4, 100.0),
+            fake_repo('/unknown_big', 20, None),
+        ]
+        # known repos take 105 / 6 = 17.5s per merge
+        self.assertEqual(
+            [r.cwd for r in main.longest_first(repos)],
+            ['/unknown_big', '/big', '/unknown_small', '/small'])
+
+    def test_longest_first_unknown(self):
+        repos = [
+            fake_repo('/a', 1, None),
+            fake_repo('/b', 3, None),
+        ]
+        self.assertEqual(
+            [r.cwd for r in main.longest_first(repos)], ['/b', '/a'])
@@ -3,10 +3,12 @@
 # Parts of the code comes from ANYBOX
 # https://github.com/anybox/anybox.recipe.odoo
 import argparse
+import json
 import os
 import shutil
 import subprocess
 import unittest
+from unittest import mock
 
 try:
     # Py 2
@@ -22,9 +24,15 @@ from tempfile import mkdtemp
 from textwrap import dedent
 
 from git_aggregator import exception, main
+from git_aggregator.metrics import metrics
+from git_aggregator.mirrors import MirrorCache
+from git_aggregator.object_store import ObjectStore
+from git_aggregator.remote_refs import RemoteRefsCache
 from git_aggregator.repo import Repo
+from git_aggregator.tracing import tracer
 from git_aggregator.utils import (
     WorkingDirectoryKeeper,
+    git_call,
     working_directory_keeper,
 )
 
@@ -57,6 +65,21 @@ def git_write_commit(repo_dir, filepath, contents, msg="Unit test commit"):
             ['git', 'rev-parse', '--verify', 'HEAD']).strip()
 
 
+def record_git_calls(repo):
+    """Record commands run through ``repo.log_call``, still running them.
+    :return: the list the commands are appended to
+    """
+    calls = []
+    log_call = repo.log_call
+
+    def recording_log_call(cmd, *args, **kw):
+        calls.append(list(cmd) if not isinstance(cmd, str) else cmd)
+        return log_call(cmd, *args, **kw)
+
+    repo.log_call = recording_log_call
+    return calls
+
+
 def path2url(path):
     return urljoin(
         'file:', pathname2url(os.path.abspath(path)))
@@ -195,6 +218,264 @@ class TestRepo(unittest.TestCase):
         self.assertEqual(rtype, 'branch')
         self.assertTrue(sha)
 
+    def test_short_sha_fetch_all(self):
+        """Abbreviated shas of fetch_all remotes come with the branches."""
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }, {
+            'name': 'r2',
+            'url': self.url_remote2
+        }]
+        merges = [{
+            'remote': 'r1',
+            'ref': 'tag1'
+        }, {
+            'remote': 'r2',
+            'ref': self.commit_3_sha.decode()[:8]
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'agg'
+        }
+        repo = Repo(self.cwd, remotes, merges, target, fetch_all=['r2'])
+        repo.aggregate()
+        self.assertEqual(git_get_last_rev(self.cwd), self.commit_3_sha)
+
+    def test_frozen_pull_request_fetch_all(self):
+        """Pinned shas no branch of a fetch_all remote has are fetched."""
+        subprocess.check_call(
+            ['git', 'checkout', '--quiet', '-b', 'pr'], cwd=self.remote1)
+        pr_sha = git_write_commit(
+            self.remote1, 'pr_file', "pr", msg="pull request").decode()
+        subprocess.check_call(
+            ['git', 'update-ref', 'refs/pull/1/head', pr_sha],
+            cwd=self.remote1)
+        subprocess.check_call(
+            ['git', 'checkout', '--quiet', 'master'], cwd=self.remote1)
+        subprocess.check_call(
+            ['git', 'branch', '--quiet', '-D', 'pr'], cwd=self.remote1)
+        subprocess.check_call(
+            ['git', 'config', 'uploadpack.allowAnySHA1InWant', 'true'],
+            cwd=self.remote1)
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }]
+        merges = [{
+            'remote': 'r1',
+            'ref': 'master',
+            'sha': self.commit_2_sha.decode(),
+        }, {
+            'remote': 'r1',
+            'ref': 'refs/pull/1/head',
+            'sha': pr_sha,
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'agg'
+        }
+        repo = Repo(self.cwd, remotes, merges, target, fetch_all=True,
+                    frozen=True, defaults={'filter': False})
+        repo.aggregate()
+        self.assertEqual(git_get_last_rev(self.cwd).decode(), pr_sha)
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'pr_file')))
+
+    def test_fetch_grouped_by_remote(self):
+        """Merges from the same remote are fetched with a single command."""
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }, {
+            'name': 'r2',
+            'url': self.url_remote2
+        }]
+        merges = [{
+            'remote': 'r1',
+            'ref': 'tag1'
+        }, {
+            'remote': 'r2',
+            'ref': 'b2'
+        }, {
+            'remote': 'r1',
+            'ref': 'master'
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'agg'
+        }
+        repo = Repo(self.cwd, remotes, merges, target)
+        calls = record_git_calls(repo)
+        repo.aggregate()
+        fetches = [c for c in calls if c[:2] == ['git', 'fetch']]
+        self.assertEqual(fetches, [
+            ['git', 'fetch', 'r1',
+             '+tag1:refs/gitaggregator/r1/tag1',
+             '+master:refs/gitaggregator/r1/master'],
+            ['git', 'fetch', 'r2', '+b2:refs/gitaggregator/r2/b2'],
+        ])
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked2')))
+
+    @mock.patch.object(Repo, '_can_merge_in_memory', return_value=False)
+    def test_merge_local_refs(self, _can_merge_in_memory):
+        """Merges use fetched refs, skipping those already in history."""
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }, {
+            'name': 'r2',
+            'url': self.url_remote2
+        }]
+        merges = [{
+            'remote': 'r1',
+            'ref': 'master'
+        }, {
+            'remote': 'r1',
+            'ref': 'tag1'
+        }, {
+            'remote': 'r2',
+            'ref': 'b2'
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'agg'
+        }
+        repo = Repo(self.cwd, remotes, merges, target)
+        calls = record_git_calls(repo)
+        repo.aggregate()
+        self.assertFalse([c for c in calls if c[:2] == ['git', 'pull']])
+        git_merges = [c for c in calls if c[:2] == ['git', 'merge']]
+        # tag1 is already in r1/master history
+        self.assertEqual(len(git_merges), 1)
+        self.assertEqual(
+            git_merges[0][-1], 'refs/gitaggregator/r2/b2^{commit}')
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked2')))
+        # refs of merges removed from the config are dropped
+        repo.merges = merges[:1]
+        repo.aggregate()
+        refs = subprocess.check_output(
+            ['git', 'for-each-ref', '--format=%(refname)',
+             'refs/gitaggregator/'], cwd=self.cwd, universal_newlines=True)
+        self.assertEqual(refs.split(), ['refs/gitaggregator/r1/master'])
+
+    def test_remote_refs_cache(self):
+        """Refs resolved once per remote url are shared between repos."""
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'master'
+        }
+        remote_refs = RemoteRefsCache()
+        repos = [
+            Repo(os.path.join(self.sandbox, name), remotes,
+                 [{'remote': 'r1', 'ref': ref}], target,
+                 remote_refs=remote_refs)
+            for name, ref in (('dst1', 'tag1'), ('dst2', 'master'))
+        ]
+        remote_refs.prefetch_repos(repos)
+        for repo in repos:
+            calls = record_git_calls(repo)
+            repo.aggregate()
+            self.assertFalse([c for c in calls if c[1] == 'ls-remote'])
+        self.assertEqual(
+            repos[0].query_remote_ref('r1', 'master'),
+            ('branch', self.commit_2_sha.decode()))
+        self.assertEqual(
+            repos[1].query_remote_ref(self.url_remote1, 'tag1'),
+            ('tag', self.commit_1_sha.decode()))
+
+    def test_merge_in_memory(self):
+        """Merges are computed without touching the working tree."""
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }, {
+            'name': 'r2',
+            'url': self.url_remote2
+        }]
+        merges = [{
+            'remote': 'r1',
+            'ref': 'tag1'
+        }, {
+            'remote': 'r1',
+            'ref': 'master'
+        }, {
+            'remote': 'r2',
+            'ref': 'b2'
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'agg'
+        }
+        repo = Repo(self.cwd, remotes, merges, target)
+        if not repo._can_merge_in_memory():
+            self.skipTest("git merge-tree --write-tree is not available")
+        calls = record_git_calls(repo)
+        repo.aggregate()
+        # tag1 is fast-forwarded to master, then b2 is merged
+        self.assertEqual(
+            len([c for c in calls if c[1] == 'merge-tree']), 1)
+        self.assertEqual(len([c for c in calls if c[1] == 'reset']), 1)
+        self.assertFalse([c for c in calls if c[1] == 'merge'])
+        with open(os.path.join(self.cwd, 'tracked')) as f:
+            self.assertEqual(f.read(), 'last')
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked2')))
+        # conflicts are reported, leaving the working tree unchanged
+        git_write_commit(
+            self.remote2, 'tracked', "conflict", msg="conflicting commit")
+        with self.assertRaises(exception.GitAggregatorException) as ex:
+            repo.aggregate()
+        self.assertIn('Merge conflict on r2 b2', ex.exception.args[0])
+        self.assertIn('tracked', ex.exception.args[0])
+        with open(os.path.join(self.cwd, 'tracked')) as f:
+            self.assertEqual(f.read(), 'last')
+
+    def test_prefix_cache(self):
+        """Only merges after the first moved one are merged again."""
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }, {
+            'name': 'r2',
+            'url': self.url_remote2
+        }]
+        merges = [{
+            'remote': 'r1',
+            'ref': 'tag1'
+        }, {
+            'remote': 'r2',
+            'ref': 'b2'
+        }, {
+            'remote': 'r1',
+            'ref': 'master'
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'agg'
+        }
+        repo = Repo(self.cwd, remotes, merges, target)
+        repo.aggregate()
+        git_write_commit(
+            self.remote1, 'tracked_new', "last", msg="new file on remote1")
+        calls = record_git_calls(repo)
+        repo.aggregate()
+        self.assertFalse(
+            [c for c in calls if 'refs/gitaggregator/r2/b2^{commit}' in c])
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked2')))
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked_new')))
+        # least recently used merges are evicted
+        with mock.patch('git_aggregator.repo.PREFIX_CACHE_SIZE', 2):
+            git_write_commit(
+                self.remote1, 'tracked_new', "new", msg="new commit")
+            repo.aggregate()
+        cache_refs = subprocess.check_output(
+            ['git', 'for-each-ref', 'refs/gitaggregator-cache/'],
+            cwd=self.cwd)
+        self.assertEqual(len(cache_refs.splitlines()), 2)
+
     def test_push_missing_remote(self):
         remotes = [{
             'name': 'r1',
@@ -257,6 +538,81 @@ class TestRepo(unittest.TestCase):
         repo.aggregate()
         self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked_new')))
 
+    def test_up_to_date(self):
+        """Aggregation is skipped when no merge moved."""
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }, {
+            'name': 'r2',
+            'url': self.url_remote2
+        }]
+        merges = [{
+            'remote': 'r1',
+            'ref': 'master'
+        }, {
+            'remote': 'r2',
+            'ref': 'b2'
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'agg'
+        }
+        repo = Repo(self.cwd, remotes, merges, target)
+        self.assertIsNone(repo.expected_duration())
+        self.assertTrue(repo.aggregate())
+        duration = repo.expected_duration()
+        self.assertGreater(duration, 0)
+        calls = record_git_calls(repo)
+        self.assertFalse(repo.aggregate())
+        self.assertFalse([c for c in calls if c[1] in ('fetch', 'reset')])
+        # the duration of the last run ranks the repo, even if up to date
+        self.assertNotEqual(repo.expected_duration(), duration)
+        # a dirty repository is not up to date
+        dummy_file = os.path.join(self.cwd, "dummy")
+        with open(dummy_file, "a"):
+            pass
+        with self.assertRaises(exception.DirtyException):
+            repo.aggregate()
+        os.remove(dummy_file)
+        # nor is one where a merge moved
+        git_write_commit(
+            self.remote2, 'tracked_new', "last", msg="new file on remote2")
+        self.assertTrue(repo.aggregate())
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked_new')))
+        self.assertFalse(repo.aggregate())
+        # nor is one with a detached HEAD
+        subprocess.check_call(
+            ['git', 'checkout', '--quiet', '--detach', 'HEAD~1'],
+            cwd=self.cwd)
+        self.assertTrue(repo.aggregate())
+        self.assertFalse(repo.aggregate())
+
+    def test_up_to_date_separate_git_dir(self):
+        """The state is stored in the git directory ``.git`` points to."""
+        remotes = [{
+            'name': 'r1',
+            'url': self.url_remote1
+        }]
+        merges = [{
+            'remote': 'r1',
+            'ref': 'master'
+        }]
+        target = {
+            'remote': 'r1',
+            'branch': 'agg'
+        }
+        repo = Repo(self.cwd, remotes, merges, target)
+        self.assertTrue(repo.aggregate())
+        git_dir = os.path.join(self.sandbox, 'separate.git')
+        subprocess.check_call(
+            ['git', 'init', '--quiet', '--separate-git-dir', git_dir],
+            cwd=self.cwd)
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, '.git')))
+        repo = Repo(self.cwd, remotes, merges, target)
+        self.assertGreater(repo.expected_duration(), 0)
+        self.assertFalse(repo.aggregate())
+
     def test_update_aggregate_2(self):
         # in this test
         # * we'll aggregate a first time r1 commit1 with r2
@@ -319,6 +675,135 @@ class TestRepo(unittest.TestCase):
         # Shallow fetch: just 1 commmit
         self.assertEqual(len(log_shallow.splitlines()), 1)
 
+    def test_filter(self):
+        """Partial clones use the filter of the defaults, and prefetch the
+        missing objects of the aggregated tree at once."""
+        for key, value in (('uploadpack.allowFilter', 'true'),
+                           ('uploadpack.allowAnySHA1InWant', 'true')):
+            subprocess.check_call(
+                ['git', 'config', key, value], cwd=self.remote1)
+        remotes = [{'name': 'r1', 'url': self.url_remote1}]
+        # the clone checks out master, the tree of tag1 is left to fetch
+        merges = [{'remote': 'r1', 'ref': 'tag1'}]
+        target = {'remote': 'r1', 'branch': 'agg'}
+        defaults = {'filter': 'tree:0', 'prefetch-blobs': True}
+        repo = Repo(self.cwd, remotes, merges, target, defaults=defaults)
+        calls = record_git_calls(repo)
+        repo.aggregate()
+        clone = next(cmd for cmd in calls if cmd[:2] == ['git', 'clone'])
+        self.assertIn('--filter=tree:0', clone)
+        # the root tree, then its blob
+        self.assertEqual(
+            len([cmd for cmd in calls if '--stdin' in cmd and
+                 'fetch' in cmd]), 2)
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'rev-list', '--objects', '--missing=print',
+                 'HEAD^{tree}'], cwd=self.cwd, universal_newlines=True
+            ).count('?'), 0)
+        with open(os.path.join(self.cwd, 'tracked')) as f:
+            self.assertEqual(f.read(), 'first')
+        # no filter
+        shutil.rmtree(self.cwd)
+        repo = Repo(self.cwd, remotes, merges, target,
+                    defaults={'filter': False, 'prefetch-blobs': True})
+        calls = record_git_calls(repo)
+        repo.aggregate()
+        clone = next(cmd for cmd in calls if cmd[:2] == ['git', 'clone'])
+        self.assertFalse([arg for arg in clone if 'filter' in arg])
+        self.assertFalse([cmd for cmd in calls if '--stdin' in cmd])
+
+    def test_sparse(self):
+        """Only the sparse directories are checked out."""
+        os.makedirs(os.path.join(self.remote1, 'd1'))
+        os.makedirs(os.path.join(self.remote1, 'd2'))
+        git_write_commit(self.remote1, 'd1/f', "d1")
+        git_write_commit(self.remote1, 'd2/f', "d2")
+        remotes = [{'name': 'r1', 'url': self.url_remote1},
+                   {'name': 'r2', 'url': self.url_remote2}]
+        merges = [{'remote': 'r1', 'ref': 'master'},
+                  {'remote': 'r2', 'ref': 'b2'}]
+        target = {'remote': 'r1', 'branch': 'agg'}
+
+        def checked_out():
+            return sorted(
+                os.path.relpath(os.path.join(dirpath, filename), self.cwd)
+                for dirpath, dirnames, filenames in os.walk(self.cwd)
+                if '.git' not in dirpath.split(os.sep)
+                for filename in filenames
+                if filename != '.git'
+            )
+
+        repo = Repo(self.cwd, remotes, merges, target, sparse=['d1/'])
+        repo.aggregate()
+        self.assertEqual(checked_out(), ['d1/f', 'tracked', 'tracked2'])
+        # the sparse directories of an existing repo change
+        repo = Repo(self.cwd, remotes, merges, target, sparse=['d2'])
+        repo.aggregate()
+        self.assertEqual(checked_out(), ['d2/f', 'tracked', 'tracked2'])
+        repo = Repo(self.cwd, remotes, merges, target)
+        repo.aggregate()
+        self.assertEqual(
+            checked_out(), ['d1/f', 'd2/f', 'tracked', 'tracked2'])
+        # repos which are not sparse run no sparse checkout command
+        git_write_commit(self.remote1, 'd1/f', "new")
+        calls = record_git_calls(repo)
+        repo.aggregate()
+        self.assertFalse(
+            [c for c in calls if c[1] in ('config', 'sparse-checkout')])
+
+    @mock.patch('git_aggregator.repo.ADAPTIVE_DEPTH_START', 1)
+    def test_depth_auto_unrelated(self):
+        """Deepening stops once it fetches nothing older."""
+        remote3 = os.path.join(self.sandbox, 'remote3')
+        subprocess.check_call(['git', 'init', '--quiet', remote3])
+        for i in range(3):
+            git_write_commit(remote3, 'unrelated', str(i))
+        remotes = [{'name': 'r1', 'url': self.url_remote1},
+                   {'name': 'r3', 'url': path2url(remote3)}]
+        merges = [{'remote': 'r1', 'ref': 'master'},
+                  {'remote': 'r3', 'ref': 'master'}]
+        target = {'remote': 'r1', 'branch': 'agg'}
+        repo = Repo(self.cwd, remotes, merges, target,
+                    defaults={'depth': 'auto'})
+        with self.assertRaises(exception.GitAggregatorException) as ex:
+            repo.aggregate()
+        self.assertIn('r3 master: the histories are unrelated',
+                      ex.exception.args[0])
+        # the history of r3 is never deepened, nor completed
+        shutil.rmtree(self.cwd)
+        merges[1]['depth'] = 1
+        repo = Repo(self.cwd, remotes, merges, target,
+                    defaults={'depth': 'auto'})
+        calls = record_git_calls(repo)
+        with self.assertRaises(exception.GitAggregatorException) as ex:
+            repo.aggregate()
+        self.assertIn('r3 master: deepening', ex.exception.args[0])
+        # it stops at the first deepen fetching nothing older
+        deepens = [c for c in calls if any('--deepen' in a for a in c)]
+        self.assertEqual(deepens[-1][2], '--deepen=4')
+
+    @mock.patch('git_aggregator.repo.ADAPTIVE_DEPTH_START', 1)
+    def test_depth_auto(self):
+        """Shallow histories are deepened until merges find their base."""
+        remotes = [{'name': 'r1', 'url': self.url_remote1},
+                   {'name': 'r2', 'url': self.url_remote2}]
+        merges = [{'remote': 'r1', 'ref': 'master'},
+                  {'remote': 'r2', 'ref': 'b2'}]
+        target = {'remote': 'r1', 'branch': 'agg'}
+        defaults = {'depth': 'auto'}
+        repo = Repo(self.cwd, remotes, merges, target, defaults=defaults)
+        calls = record_git_calls(repo)
+        repo.aggregate()
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked2')))
+        # the merge base, commit 1, is one commit behind the fetched ones
+        deepens = [c for c in calls if '--deepen=1' in c]
+        self.assertEqual(len(deepens), 2)
+        self.assertEqual(repo._read_state()['depth'], 2)
+        # later runs start from the depth that was needed
+        repo = Repo(self.cwd, remotes, merges, target, defaults=defaults)
+        self.assertEqual(repo._fetch_options({}), ('--depth', '2'))
+
     def test_force(self):
         """Ensure --force works fine."""
         remotes = [{
@@ -426,6 +911,12 @@ class TestRepo(unittest.TestCase):
             expand_env=False,
             env_file=None,
             force=False,
+            trace=None,
+            metrics_file=None,
+            object_store=None,
+            cache_dir=None,
+            github_concurrency=8,
+            frozen=False,
         )
 
         with working_directory_keeper:
@@ -444,3 +935,611 @@ class TestRepo(unittest.TestCase):
 
         self.assertTrue(os.path.isfile(os.path.join(repo3_dir, 'tracked')))
         self.assertTrue(os.path.isfile(os.path.join(repo3_dir, 'tracked2')))
+
+    def test_object_store(self):
+        """Repos with the same remote borrow the objects of one store."""
+        config_yaml = os.path.join(self.sandbox, 'config.yaml')
+        with open(config_yaml, 'w') as f:
+            f.write(dedent("""
+            ./repo1:
+                remotes:
+                    r1: %(r1_remote_url)s
+                merges:
+                    - r1 tag1
+                target: r1 agg
+            ./repo2:
+                remotes:
+                    r1: %(r1_remote_url)s
+                    r2: %(r2_remote_url)s
+                merges:
+                    - r1 master
+                    - r2 b2
+                target: r1 agg
+            """ % {
+                'r1_remote_url': self.url_remote1,
+                'r2_remote_url': self.url_remote2,
+            }))
+        store_dir = os.path.join(self.sandbox, 'store')
+        args = argparse.Namespace(
+            command='aggregate',
+            config=config_yaml,
+            jobs=2,
+            dirmatch=None,
+            do_push=False,
+            expand_env=False,
+            env_file=None,
+            force=False,
+            trace=None,
+            metrics_file=None,
+            object_store=store_dir,
+            cache_dir=None,
+            github_concurrency=8,
+            frozen=False,
+        )
+        subprocess.check_call(
+            ['git', 'config', 'uploadpack.allowFilter', 'true'],
+            cwd=self.remote1)
+        with working_directory_keeper:
+            os.chdir(self.sandbox)
+            main.run(args)
+        store = ObjectStore(store_dir)
+        store1 = store.store_path(self.url_remote1, 'blob:none')
+        store2 = store.store_path(self.url_remote2, 'blob:none')
+        # one store per remote url, with the merges of all repos
+        self.assertEqual(
+            sorted(os.listdir(store_dir)),
+            sorted(os.path.basename(path) for path in (store1, store2)))
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'for-each-ref', '--format=%(refname)'],
+                cwd=store1, universal_newlines=True).split(),
+            ['refs/gitaggregator/master', 'refs/gitaggregator/tag1'])
+
+        def alternates(name):
+            path = os.path.join(
+                self.sandbox, name, '.git', 'objects', 'info', 'alternates')
+            with open(path) as f:
+                return sorted(os.path.normpath(line.strip()) for line in f)
+
+        self.assertEqual(
+            alternates('repo1'), [os.path.join(store1, 'objects')])
+        self.assertEqual(alternates('repo2'), sorted(
+            os.path.join(path, 'objects') for path in (store1, store2)))
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.sandbox, 'repo2', 'tracked2')))
+        # the stores are partial clones, like the repos
+        self.assertIn('?', [
+            line[0] for line in subprocess.check_output(
+                ['git', 'rev-list', '--objects', '--missing=print',
+                 'refs/gitaggregator/master'],
+                cwd=store1, universal_newlines=True).splitlines()])
+        # stores are not fetched again until merges move
+        with working_directory_keeper, mock.patch(
+                'git_aggregator.object_store.git_call',
+                side_effect=git_call) as store_call:
+            os.chdir(self.sandbox)
+            main.run(args)
+        calls = [c.args[0] for c in store_call.call_args_list]
+        self.assertTrue(calls)
+        self.assertFalse([c for c in calls if 'fetch' in c])
+        # and then follow them
+        new_sha = git_write_commit(
+            self.remote1, 'tracked_new', "new", msg="new commit").decode()
+        with working_directory_keeper:
+            os.chdir(self.sandbox)
+            main.run(args)
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'rev-parse', 'refs/gitaggregator/master'],
+                cwd=store1, universal_newlines=True).strip(),
+            new_sha)
+
+    def test_object_store_shallow(self):
+        """Shallow repos, whatever their shallow option, use no store."""
+        remotes = [{'name': 'r1', 'url': self.url_remote1}]
+        merges = [{'remote': 'r1', 'ref': 'master'}]
+        target = {'remote': 'r1', 'branch': 'agg'}
+        self.assertFalse(ObjectStore.is_shallow(
+            Repo(self.cwd, remotes, merges, target)))
+        for option in ('depth', 'shallow-since', 'shallow-exclude'):
+            self.assertTrue(ObjectStore.is_shallow(Repo(
+                self.cwd, remotes, merges, target,
+                defaults={option: '1'})))
+            self.assertTrue(ObjectStore.is_shallow(Repo(
+                self.cwd, remotes, [dict(merges[0], **{option: '1'})],
+                target)))
+
+    def test_mirror_cache(self):
+        """Repos are fetched from mirrors refreshed after a ttl, and push
+        to their remotes."""
+        config_yaml = os.path.join(self.sandbox, 'config.yaml')
+        with open(config_yaml, 'w') as f:
+            f.write(dedent("""
+            ./repo1:
+                remotes:
+                    r1: %(r1_remote_path)s
+                merges:
+                    - r1 master
+                target: r1 agg
+            ./repo2:
+                remotes:
+                    r1: %(r1_remote_url)s
+                    r2: %(r2_remote_url)s
+                merges:
+                    - r1 master
+                    - r2 b2
+                target: r2 agg
+                mirror: false
+            """ % {
+                'r1_remote_path': self.remote1,
+                'r1_remote_url': self.url_remote1,
+                'r2_remote_url': self.url_remote2,
+            }))
+        cache_dir = os.path.join(self.sandbox, 'cache')
+        args = argparse.Namespace(
+            command='aggregate',
+            config=config_yaml,
+            jobs=1,
+            dirmatch=None,
+            do_push=True,
+            expand_env=False,
+            env_file=None,
+            force=False,
+            trace=None,
+            metrics_file=None,
+            object_store=None,
+            cache_dir=cache_dir,
+            cache_ttl=3600,
+            cache_max_size=None,
+            github_concurrency=8,
+            frozen=False,
+        )
+
+        def run():
+            with working_directory_keeper:
+                os.chdir(self.sandbox)
+                main.run(args)
+
+        with mock.patch.object(
+                RemoteRefsCache, 'prefetch', autospec=True,
+                side_effect=RemoteRefsCache.prefetch) as prefetch:
+            run()
+        # only the refs of the remotes of repo2 are listed on the remotes
+        self.assertEqual(
+            sorted(c.args[1:] for c in prefetch.call_args_list), [
+                (self.url_remote1, {'master'}),
+                (self.url_remote2, {'agg', 'b2'}),
+            ])
+        mirror1 = MirrorCache(cache_dir).mirror_path(self.remote1)
+        repo1_dir = os.path.join(self.sandbox, 'repo1')
+        repo2_dir = os.path.join(self.sandbox, 'repo2')
+        self.assertEqual(
+            [name for name in os.listdir(cache_dir) if name.endswith('.git')],
+            [os.path.basename(mirror1)])
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'remote', 'get-url', 'r1'], cwd=repo1_dir,
+                universal_newlines=True).strip(),
+            path2url(mirror1))
+        # local paths are cloned as file:// urls, honouring filters
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'remote', 'get-url', 'origin'], cwd=mirror1,
+                universal_newlines=True).strip(),
+            self.url_remote1)
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'config', 'remote.origin.promisor'], cwd=repo1_dir,
+                universal_newlines=True).strip(),
+            'true')
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'remote', 'get-url', 'r1'], cwd=repo2_dir,
+                universal_newlines=True).strip(),
+            self.url_remote1)
+        # the aggregated branch was pushed to the remote
+        self.assertEqual(
+            subprocess.check_output(
+                ['git', 'rev-parse', 'agg'], cwd=self.remote1),
+            subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=repo1_dir))
+        git_write_commit(self.remote1, 'tracked3', "new", msg="new")
+        # the mirror is fresh, the remote is not queried
+        run()
+        self.assertFalse(os.path.exists(os.path.join(repo1_dir, 'tracked3')))
+        self.assertTrue(os.path.exists(os.path.join(repo2_dir, 'tracked3')))
+        args.cache_ttl = 0
+        run()
+        self.assertTrue(os.path.exists(os.path.join(repo1_dir, 'tracked3')))
+        # unused mirrors are evicted
+        MirrorCache(cache_dir, max_size=0).close()
+        self.assertFalse(os.path.exists(mirror1))
+
+    def test_multithreading_error(self):
+        """An error in one repo makes the whole run fail."""
+        config_yaml = os.path.join(self.sandbox, 'config.yaml')
+        with open(config_yaml, 'w') as f:
+            f.write(dedent("""
+            ./repo1:
+                remotes:
+                    r1: %(r1_remote_url)s
+                merges:
+                    - r1 tag1
+                target: r1 agg
+            ./repo2:
+                remotes:
+                    r1: %(r1_remote_url)s
+                merges:
+                    - r1 does-not-exist
+                target: r1 agg
+            """ % {
+                'r1_remote_url': self.url_remote1,
+            }))
+
+        args = argparse.Namespace(
+            command='aggregate',
+            config=config_yaml,
+            jobs=2,
+            dirmatch=None,
+            do_push=False,
+            expand_env=False,
+            env_file=None,
+            force=False,
+            trace=None,
+            metrics_file=None,
+            object_store=None,
+            cache_dir=None,
+            github_concurrency=8,
+            frozen=False,
+        )
+
+        with working_directory_keeper:
+            os.chdir(self.sandbox)
+            with self.assertRaises(SystemExit) as ex:
+                main.run(args)
+        self.assertEqual(ex.exception.code, 1)
+
+    def test_lock_frozen(self):
+        """Aggregate shas pinned in the lock file, without ls-remote."""
+        config_yaml = os.path.join(self.sandbox, 'repos.yaml')
+        with open(config_yaml, 'w') as f:
+            f.write(dedent("""
+            ./dst:
+                remotes:
+                    r1: %(r1_remote_url)s
+                    r2: %(r2_remote_url)s
+                merges:
+                    - r1 master
+                    - r2 b2
+                target: r1 agg
+            """ % {
+                'r1_remote_url': self.url_remote1,
+                'r2_remote_url': self.url_remote2,
+            }))
+        args = argparse.Namespace(
+            command='lock',
+            config=config_yaml,
+            jobs=1,
+            dirmatch=None,
+            do_push=False,
+            expand_env=False,
+            env_file=None,
+            force=False,
+            trace=None,
+            metrics_file=None,
+            object_store=None,
+            cache_dir=None,
+            github_concurrency=8,
+            frozen=False,
+        )
+        with working_directory_keeper:
+            os.chdir(self.sandbox)
+            main.run(args)
+            lock_path = os.path.join(self.sandbox, 'repos.lock.yaml')
+            self.assertTrue(os.path.isfile(lock_path))
+            git_write_commit(
+                self.remote1, 'tracked_new', "last", msg="new file on remote1")
+            args.command = 'aggregate'
+            args.frozen = True
+            with mock.patch.object(
+                    Repo, 'log_call', autospec=True,
+                    side_effect=Repo.log_call) as log_call:
+                main.run(args)
+        calls = [c.args[1] for c in log_call.call_args_list]
+        self.assertFalse([c for c in calls if c[1] == 'ls-remote'])
+        self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked2')))
+        self.assertFalse(
+            os.path.isfile(os.path.join(self.cwd, 'tracked_new')))
+
+    def test_lock_frozen_dirmatch(self):
+        """Only the repos selected with -d need to be in the lock file."""
+        config_yaml = os.path.join(self.sandbox, 'repos.yaml')
+        with open(config_yaml, 'w') as f:
+            f.write(dedent("""
+            ./dst:
+                remotes:
+                    r1: %(r1_remote_url)s
+                merges:
+                    - r1 master
+                target: r1 agg
+            ./other:
+                remotes:
+                    r2: %(r2_remote_url)s
+                merges:
+                    - r2 b2
+                target: r2 agg
+            """ % {
+                'r1_remote_url': self.url_remote1,
+                'r2_remote_url': self.url_remote2,
+            }))
+        args = argparse.Namespace(
+            command='lock',
+            config=config_yaml,
+            jobs=1,
+            dirmatch='./dst',
+            do_push=False,
+            expand_env=False,
+            env_file=None,
+            force=False,
+            trace=None,
+            metrics_file=None,
+            object_store=None,
+            cache_dir=None,
+            github_concurrency=8,
+            frozen=False,
+        )
+        with working_directory_keeper:
+            os.chdir(self.sandbox)
+            main.run(args)
+            args.command = 'aggregate'
+            args.frozen = True
+            main.run(args)
+            self.assertTrue(os.path.isfile(os.path.join(self.cwd, 'tracked')))
+            self.assertFalse(
+                os.path.exists(os.path.join(self.sandbox, 'other')))
+            args.dirmatch = None
+            with self.assertRaises(exception.ConfigException):
+                main.run(args)
+
+    def test_trace(self):
+        """--trace writes the phases and git calls of each repo."""
+        config_yaml = os.path.join(self.sandbox, 'config.yaml')
+        with open(config_yaml, 'w') as f:
+            f.write(dedent("""
+            ./repo1:
+                remotes:
+                    r1: %(r1_remote_url)s
+                    r2: %(r2_remote_url)s
+                merges:
+                    - r1 tag1
+                    - r2 b2
+                target: r1 agg
+            """ % {
+                'r1_remote_url': self.url_remote1,
+                'r2_remote_url': self.url_remote2,
+            }))
+        trace_path = os.path.join(self.sandbox, 'trace.json')
+        args = argparse.Namespace(
+            command='aggregate',
+            config=config_yaml,
+            jobs=2,
+            dirmatch=None,
+            do_push=False,
+            expand_env=False,
+            env_file=None,
+            force=False,
+            trace=trace_path,
+            metrics_file=None,
+            object_store=None,
+            cache_dir=None,
+            github_concurrency=8,
+            frozen=False,
+        )
+        with working_directory_keeper, \
+                mock.patch.object(tracer, 'enabled', False), \
+                mock.patch.object(tracer, '_events', []), \
+                mock.patch.object(tracer, '_threads', {}):
+            os.chdir(self.sandbox)
+            main.run(args)
+        with open(trace_path) as f:
+            events = json.load(f)['traceEvents']
+        spans = [e for e in events if e['ph'] == 'X']
+        phases = {e['name'] for e in spans if e['cat'] == 'phase'}
+        self.assertTrue(
+            {'clone', 'remotes', 'fetch', 'reset', 'merge'} <= phases)
+        git_calls = [e for e in spans if e['cat'] == 'git']
+        self.assertIn('git fetch', {e['name'] for e in git_calls})
+        self.assertTrue(all('status' in e['args'] for e in git_calls))
+        threads = {
+            e['args']['name'] for e in events if e['name'] == 'thread_name'}
+        self.assertIn('repo1', threads)
+
+    def test_metrics_file(self):
+        """--metrics-file writes per repo metrics, failed repos included."""
+        config_yaml = os.path.join(self.sandbox, 'config.yaml')
+        with open(config_yaml, 'w') as f:
+            f.write(dedent("""
+            ./repo1:
+                remotes:
+                    r1: %(r1_remote_url)s
+                    r2: %(r2_remote_url)s
+                merges:
+                    - r1 tag1
+                    - r2 b2
+                target: r1 agg
+            ./repo2:
+                remotes:
+                    r1: %(r1_remote_url)s
+                merges:
+                    - r1 does-not-exist
+                target: r1 agg
+            """ % {
+                'r1_remote_url': self.url_remote1,
+                'r2_remote_url': self.url_remote2,
+            }))
+        metrics_path = os.path.join(self.sandbox, 'metrics.prom')
+        args = argparse.Namespace(
+            command='aggregate',
+            config=config_yaml,
+            jobs=1,
+            dirmatch='*/repo1',
+            do_push=False,
+            expand_env=False,
+            env_file=None,
+            force=False,
+            trace=None,
+            metrics_file=metrics_path,
+            object_store=None,
+            cache_dir=None,
+            github_concurrency=8,
+            frozen=False,
+        )
+
+        def read_metrics():
+            with open(metrics_path) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines[-1], '# EOF')
+            return dict(
+                line.rsplit(' ', 1) for line in lines
+                if not line.startswith('#'))
+
+        repo1 = os.path.join(self.sandbox, 'repo1')
+        repo2 = os.path.join(self.sandbox, 'repo2')
+        with working_directory_keeper, \
+                mock.patch.object(metrics, 'enabled', False), \
+                mock.patch.object(metrics, '_repos', {}), \
+                mock.patch.object(metrics, '_run', {}):
+            os.chdir(self.sandbox)
+            main.run(args)
+            values = read_metrics()
+            self.assertEqual(values[
+                'gitaggregator_repo_status{repo="%s",status="ok"}' % repo1
+            ], '1')
+            self.assertEqual(values[
+                'gitaggregator_repo_status{repo="%s",status="skipped"}'
+                % repo2
+            ], '1')
+            self.assertEqual(values[
+                'gitaggregator_repo_merges{repo="%s"}' % repo1], '1')
+            self.assertEqual(values[
+                'gitaggregator_repo_fetches{repo="%s"}' % repo1], '2')
+            self.assertGreater(int(values[
+                'gitaggregator_repo_git_subprocesses{repo="%s"}' % repo1
+            ]), 5)
+            # the ls-remote of the prefetch, run for all repos
+            self.assertEqual(
+                values['gitaggregator_run_git_subprocesses'], '2')
+            self.assertIn('gitaggregator_run_duration_seconds', values)
+
+            metrics._repos.clear()
+            args.dirmatch = None
+            with self.assertRaises(SystemExit):
+                main.run(args)
+            values = read_metrics()
+            self.assertEqual(values[
+                'gitaggregator_repo_status{repo="%s",status="up_to_date"}'
+                % repo1
+            ], '1')
+            self.assertEqual(values[
+                'gitaggregator_repo_status{repo="%s",status="failed"}'
+                % repo2
+            ], '1')
+
+    def test_offline_prs(self):
+        """Merged PRs are told from local commits, others are queried."""
+        github_url = 'https://github.com/OCA/test.git'
+        subprocess.check_call(
+            ['git', 'update-ref', 'refs/pull/1/head', self.commit_1_sha],
+            cwd=self.remote1)
+        subprocess.check_call(
+            ['git', 'checkout', '-b', 'pr2', 'tag1'], cwd=self.remote1)
+        git_write_commit(self.remote1, 'pr2', "pr2", msg="pr2")
+        subprocess.check_call(
+            ['git', 'update-ref', 'refs/pull/2/head', 'pr2'],
+            cwd=self.remote1)
+        subprocess.check_call(['git', 'checkout', 'master'], cwd=self.remote1)
+        queried = []
+
+        def iter_many(paths):
+            paths = list(paths)
+            queried.extend(paths)
+            return iter([
+                mock.Mock(status_code=404, reason='Not Found')
+                for path in paths
+            ])
+
+        repo = Repo(
+            self.cwd,
+            [{'name': 'oca', 'url': github_url}],
+            [{'remote': 'oca', 'ref': 'master'},
+             {'remote': 'oca', 'ref': 'refs/pull/1/head'},
+             {'remote': 'oca', 'ref': 'refs/pull/2/head'}],
+            {'remote': 'oca', 'branch': 'agg'},
+            github=mock.Mock(
+                pull=mock.Mock(return_value=None), iter_many=iter_many),
+        )
+        # fetch github_url from remote1
+        env = {
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': 'url.%s.insteadOf' % self.url_remote1,
+            'GIT_CONFIG_VALUE_0': github_url,
+        }
+        with mock.patch.dict(os.environ, env):
+            repo.aggregate()
+        with self.assertLogs('git_aggregator.repo', 'WARNING'):
+            all_prs = repo.collect_prs_info(offline=True)
+        self.assertEqual(list(all_prs), ['closed'])
+        self.assertEqual(
+            [(pr['pr'], pr['url'], pr['merged']) for pr in all_prs['closed']],
+            [('1', 'https://github.com/OCA/test/pull/1', 'merged')])
+        # only the PR that is not merged was queried
+        self.assertEqual(queried, ['/repos/OCA/test/pulls/2'])
+
+    def test_moved_prs(self):
+        """PRs whose head changed on the remote since the fetch are listed."""
+        github_url = 'https://github.com/OCA/test.git'
+        subprocess.check_call(
+            ['git', 'update-ref', 'refs/pull/1/head', self.commit_1_sha],
+            cwd=self.remote1)
+        repo = Repo(
+            self.cwd,
+            [{'name': 'oca', 'url': github_url}],
+            [{'remote': 'oca', 'ref': 'master'},
+             {'remote': 'oca', 'ref': 'refs/pull/1/head'}],
+            {'remote': 'oca', 'branch': 'agg'},
+        )
+        env = {
+            'GIT_CONFIG_COUNT': '1',
+            'GIT_CONFIG_KEY_0': 'url.%s.insteadOf' % self.url_remote1,
+            'GIT_CONFIG_VALUE_0': github_url,
+        }
+        with mock.patch.dict(os.environ, env):
+            self.assertEqual(
+                [(pr['pr'], pr['old']) for pr in
+                 repo.moved_pull_requests()],
+                [('1', None)])
+            repo.aggregate()
+            self.assertEqual(repo.moved_pull_requests(), [])
+            subprocess.check_call(
+                ['git', 'update-ref', 'refs/pull/1/head', self.commit_2_sha],
+                cwd=self.remote1)
+            # with the pull requests listed at once
+            repo.remote_refs = RemoteRefsCache()
+            repo.remote_refs.prefetch_pulls([repo])
+            with self.assertLogs('git_aggregator.repo', 'INFO') as logs:
+                moved = repo.show_moved_prs()
+        self.assertEqual(
+            [(pr['pr'], pr['old'], pr['new']) for pr in moved],
+            [('1', self.commit_1_sha.decode(), self.commit_2_sha.decode())])
+        self.assertIn('moved from', logs.output[0])
+
+
+class TestRepoStepByStep(TestRepo):
+    """Run all tests merging in the working tree, one merge at a time."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(
+            Repo, '_can_merge_in_memory', return_value=False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
@@ -0,0 +1,63 @@
+# © 2026 ACSONE SA/NV
+# License AGPLv3 (http://www.gnu.org/licenses/agpl-3.0-standalone.html)
+import subprocess
+import threading
+import time
+import unittest
+
+from git_aggregator.exception import CancelledException
+from git_aggregator.runner import AsyncGitRunner
+
+
+class TestAsyncGitRunner(unittest.TestCase):
+
+    def test_call(self):
+        with AsyncGitRunner(2) as runner:
+            self.assertEqual(
+                runner.call(['echo', 'foo'], subprocess.check_output),
+                b'foo\n')
+            self.assertEqual(
+                runner.call('cat', subprocess.check_output, shell=True,
+                            input=b'bar'),
+                b'bar')
+            self.assertEqual(runner.call(['false'], subprocess.call), 1)
+            with self.assertRaises(subprocess.CalledProcessError):
+                runner.call(['false'])
+
+    def test_max_processes(self):
+        """Processes beyond the limit wait for a free slot."""
+        with AsyncGitRunner(2) as runner:
+            threads = [
+                threading.Thread(target=runner.call, args=(['sleep', '0.3'],))
+                for __ in range(4)
+            ]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertGreaterEqual(time.time() - start, 0.6)
+
+    def test_cancel(self):
+        """Cancelling kills running processes and refuses new ones."""
+        errors = []
+
+        def call():
+            try:
+                runner.call(['sleep', '10'])
+            except CancelledException as e:
+                errors.append(e)
+
+        with AsyncGitRunner(1) as runner:
+            threads = [threading.Thread(target=call) for __ in range(2)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.2)
+            start = time.time()
+            runner.cancel()
+            for thread in threads:
+                thread.join()
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(len(errors), 2)
+            with self.assertRaises(CancelledException):
+                runner.call(['true'])